@@ -0,0 +1,124 @@
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import xmlrpc.client
+
+from blockio import KeepAliveTransport
+from blockprotocol import BinaryBlockClient
+
+#### Benchmark: XMLRPC vs binary block protocol
+# Starts a block server (unless -port points to one already running) and measures, for each protocol,
+# the time per block of Get, Put and batched GetMany/PutMany, and the bytes on the wire per block.
+# Bytes are counted by relaying the connection through a small TCP proxy; times are measured directly.
+
+## TCP relay that counts the bytes going each way
+
+class CountingProxy():
+    def __init__(self, target_port):
+        self.target = ('127.0.0.1', target_port)
+        self.sent = 0
+        self.received = 0
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen()
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.Accept, daemon=True).start()
+
+    def Accept(self):
+        while True:
+            client, address = self.listener.accept()
+            server = socket.create_connection(self.target)
+            threading.Thread(target=self.Relay, args=(client, server, 'sent'), daemon=True).start()
+            threading.Thread(target=self.Relay, args=(server, client, 'received'), daemon=True).start()
+
+    def Relay(self, source, destination, counter):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                setattr(self, counter, getattr(self, counter) + len(data))
+                destination.sendall(data)
+        except OSError:
+            pass
+        finally:
+            destination.close()
+
+    def Reset(self):
+        self.sent = 0
+        self.received = 0
+
+
+def Connect(protocol, port):
+    if protocol == 'binary':
+        return BinaryBlockClient('127.0.0.1', port)
+    return xmlrpc.client.ServerProxy('http://127.0.0.1:' + str(port), transport=KeepAliveTransport())
+
+
+## Runs every operation on one protocol; returns {operation: (microseconds per block, bytes per block)}
+
+def Measure(protocol, port, proxy, block_size, num_blocks, batch):
+    # random data: XMLRPC gzips large replies, which would flatter it on compressible blocks
+    data = [os.urandom(block_size) for i in range(num_blocks)]
+    results = {}
+    operations = [
+        ('Put', lambda server: [server.Put(i, data[i]) for i in range(num_blocks)]),
+        ('Get', lambda server: [server.Get(i) for i in range(num_blocks)]),
+        ('PutMany', lambda server: [server.PutMany([(j, data[j]) for j in range(i, min(i+batch, num_blocks))])
+                                    for i in range(0, num_blocks, batch)]),
+        ('GetMany', lambda server: [server.GetMany(list(range(i, min(i+batch, num_blocks))))
+                                    for i in range(0, num_blocks, batch)]),
+    ]
+    direct = Connect(protocol, port)
+    counted = Connect(protocol, proxy.port)
+    for name, run in operations:
+        # warm up the connection, then time it
+        run(direct)
+        start = time.perf_counter()
+        run(direct)
+        elapsed = time.perf_counter() - start
+        run(counted)
+        proxy.Reset()
+        run(counted)
+        # let the relay threads finish counting
+        time.sleep(0.05)
+        results[name] = (elapsed * 1e6 / num_blocks, (proxy.sent + proxy.received) / num_blocks)
+    return results
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-bs', '--block_size', type=int, default=128, help='an integer value')
+    ap.add_argument('-nb', '--num_blocks', type=int, default=1000, help='number of blocks per operation')
+    ap.add_argument('-batch', '--batch', type=int, default=32, help='blocks per GetMany/PutMany call')
+    ap.add_argument('-port', '--port', type=int, help='port of a running block server (default: start one)')
+    args = ap.parse_args()
+
+    server_process = None
+    port = args.port
+    if not port:
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        server_process = subprocess.Popen([sys.executable, 'blockserver.py', '-nb', str(args.num_blocks),
+                                           '-bs', str(args.block_size), '-port', str(port)],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    try:
+        proxy = CountingProxy(port)
+        print('Block size ' + str(args.block_size) + ' B, ' + str(args.num_blocks) + ' blocks, batches of ' + str(args.batch))
+        print('%-8s %-8s %12s %14s' % ('protocol', 'call', 'us/block', 'bytes/block'))
+        for protocol in ('xmlrpc', 'binary'):
+            results = Measure(protocol, port, proxy, args.block_size, args.num_blocks, args.batch)
+            for name in results:
+                print('%-8s %-8s %12.1f %14.1f' % (protocol, name, results[name][0], results[name][1]))
+    finally:
+        if server_process is not None:
+            server_process.kill()
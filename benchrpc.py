@@ -0,0 +1,160 @@
+import builtins
+import socket
+import subprocess
+import sys
+import time
+
+import fsconfig
+from fsmain import ArgumentParser
+from block import DiskBlocks
+from filename import FileName
+from fileoperations import FileOperations
+from absolutepath import AbsolutePathName
+from shell import FSShell
+
+#### Benchmark: RPCs per block write and per shell command
+# Starts the block servers (unless -startport points to running ones, or with -backend local), runs a fixed list of shell commands
+# through FSShell, and counts the RPCs each one sends to the block servers. With -check, exits with
+# status 1 if a count is above its budget in BUDGET, so a change that adds RPCs is noticed.
+# Takes the file system options of fsmain.py; the budgets are for the default configuration
+# (4 servers, XMLRPC, write-through cache).
+
+COMMANDS = [
+    'mkdir d1',
+    'create f1',
+    'append f1 ' + 'abcdefghij' * 20,
+    'cat f1',
+    'ls',
+    'cd d1',
+    'create f2',
+    'append f2 xyz',
+    'cd ..',
+    'lns f1 s1',
+    'lnh f1 h1',
+    'mirror f1',
+    'slice f1 2 5',
+    'rm h1',
+    'showblock 5',
+    'showinode 0',
+]
+
+# maximum RPCs per measurement: the counts of the default configuration
+BUDGET = {
+    'Acquire+Release (no writes)': 3,
+    'Put (holding the lock)': 2,
+    'Put (without the lock)': 4,
+    'mkdir d1': 22,
+    'create f1': 11,
+    'append f1': 14,
+    'cat f1': 3,
+    'ls': 3,
+    'cd d1': 3,
+    'create f2': 11,
+    'append f2': 10,
+    'cd ..': 3,
+    'lns f1': 16,
+    'lnh f1': 11,
+    'mirror f1': 8,
+    'slice f1': 7,
+    'rm h1': 9,
+    'showblock 5': 1,
+    'showinode 0': 0,
+}
+
+
+def Requests(RawBlocks):
+    return sum(stats['requests'] for stats in RawBlocks.ConnectionStats())
+
+
+## Measures single block writes, with and without the lock; returns [(name, RPCs)]
+
+def MeasurePut(RawBlocks):
+    results = []
+    block = bytearray(b'\x07') * fsconfig.BLOCK_SIZE
+    block_number = fsconfig.TOTAL_NUM_BLOCKS - 3
+    # first critical section: the last writer is flagged by its Release
+    RawBlocks.Acquire()
+    RawBlocks.Put(block_number, block)
+    RawBlocks.Release()
+    start = Requests(RawBlocks)
+    RawBlocks.Acquire()
+    RawBlocks.Release()
+    results.append(('Acquire+Release (no writes)', Requests(RawBlocks) - start))
+    RawBlocks.Acquire()
+    start = Requests(RawBlocks)
+    RawBlocks.Put(block_number, block)
+    results.append(('Put (holding the lock)', Requests(RawBlocks) - start))
+    RawBlocks.Release()
+    start = Requests(RawBlocks)
+    RawBlocks.Put(block_number, block)
+    results.append(('Put (without the lock)', Requests(RawBlocks) - start))
+    return results
+
+
+## Runs COMMANDS through the shell; returns [(command, RPCs)], counted between the shell's prompts
+
+def MeasureCommands(RawBlocks, shell):
+    results = []
+    pending = list(COMMANDS) + ['exit']
+    state = {'command': None, 'start': 0}
+
+    def NextCommand(prompt):
+        if state['command'] is not None:
+            results.append((state['command'], Requests(RawBlocks) - state['start']))
+        command = pending.pop(0)
+        # commands with long arguments are reported by their first two words
+        state['command'] = ' '.join(command.split()[0:2]) if command != 'exit' else None
+        state['start'] = Requests(RawBlocks)
+        return command
+
+    input_function = builtins.input
+    builtins.input = NextCommand
+    try:
+        shell.Interpreter()
+    finally:
+        builtins.input = input_function
+    return results
+
+
+if __name__ == "__main__":
+
+    ap = ArgumentParser()
+    ap.add_argument('-check', '--check', action='store_true', help='exit with status 1 if a count is above its budget')
+    args = ap.parse_args()
+    if args.number_of_servers is None:
+        args.number_of_servers = 4
+
+    server_processes = []
+    if not args.startport and args.backend != 'local':
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        args.startport = probe.getsockname()[1]
+        probe.close()
+        for i in range(0, args.number_of_servers):
+            server_processes.append(subprocess.Popen([sys.executable, 'blockserver.py', '-nb', str(args.total_num_blocks or 256),
+                                                      '-bs', str(args.block_size or 128), '-port', str(args.startport + i)],
+                                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        time.sleep(1)
+
+    try:
+        fsconfig.ConfigureFSConstants(args)
+        RawBlocks = DiskBlocks()
+        FileObject = FileName(RawBlocks)
+        FileObject.InitRootInode()
+        shell = FSShell(RawBlocks, FileOperations(FileObject), AbsolutePathName(FileObject))
+
+        results = MeasurePut(RawBlocks) + MeasureCommands(RawBlocks, shell)
+        over = 0
+        print('%-30s %6s %6s' % ('operation', 'RPCs', 'budget'))
+        for name, count in results:
+            budget = BUDGET.get(name)
+            flag = ''
+            if budget is not None and count > budget:
+                flag = '  OVER BUDGET'
+                over += 1
+            print('%-30s %6d %6s%s' % (name, count, budget if budget is not None else '-', flag))
+        if args.check and over > 0:
+            sys.exit(1)
+    finally:
+        for process in server_processes:
+            process.kill()
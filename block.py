@@ -1,11 +1,21 @@
-import pickle, logging
+import logging, os
 import fsconfig
-import xmlrpc.client, socket, time
+import xmlrpc.client, socket, time, random
+import blocklayout
+import blockio
+from blockio import ParallelIO, InlineIO, KeepAliveTransport, ServerHealth, ServerLoad
+from blocklocal import LocalBlockServer
+from blockprotocol import BinaryBlockClient, ZERO_BLOCK
+from blockcache import BlockCache
+import blockdump
 
 #### BLOCK LAYER
 
 # global TOTAL_NUM_BLOCKS, BLOCK_SIZE, INODE_SIZE, MAX_NUM_INODES, MAX_FILENAME, INODE_NUMBER_DIRENTRY_SIZE
 
+# what a block server returns in place of a block that fails its checksum (see blockserver.CORRUPT)
+CORRUPT = b''
+
 class DiskBlocks():
     def __init__(self):
         # initialize clientID
@@ -15,22 +25,241 @@ class DiskBlocks():
             print('Must specify valid cid')
             quit()
         self.server_list = []
+        # connection of each server; keeps its statistics
+        self.connections = []
+        # where each block is stored, and the redundancy of the array (see blocklayout.py)
+        self.layout = blocklayout.NewLayout(fsconfig.RAID_LEVEL, fsconfig.NUM_SERVERS, fsconfig.TOTAL_NUM_BLOCKS,
+                                            fsconfig.BLOCK_SIZE, fsconfig.STRIPE_UNIT)
         # initialize XMLRPC client connection to raw block server
         if fsconfig.PORT:
             PORT = fsconfig.PORT
-        else:
+        elif fsconfig.BACKEND != 'local':
             print('Must specify port number')
             quit()
         for i in range (0,fsconfig.NUM_SERVERS):
-            server_url = 'http://' + fsconfig.SERVER_ADDRESS + ':' + str(PORT+i)
-            self.server_list.append(xmlrpc.client.ServerProxy(server_url,use_builtin_types=True))
+            if fsconfig.BACKEND == 'local':
+                # in-process server holding this server's stripe levels in memory (see blocklocal.py)
+                server = LocalBlockServer(self.layout.num_levels, fsconfig.BLOCK_SIZE)
+                self.server_list.append(server)
+                self.connections.append(server)
+            elif fsconfig.PROTOCOL == 'binary':
+                # binary block protocol: raw block payloads in length-prefixed frames
+                server = BinaryBlockClient(fsconfig.SERVER_ADDRESS, PORT+i)
+                self.server_list.append(server)
+                self.connections.append(server)
+            else:
+                server_url = 'http://' + fsconfig.SERVER_ADDRESS + ':' + str(PORT+i)
+                # keep-alive transport: one persistent HTTP/1.1 connection per server
+                transport = KeepAliveTransport()
+                self.server_list.append(xmlrpc.client.ServerProxy(server_url,transport=transport))
+                self.connections.append(transport)
         #server_url = 'http://' + fsconfig.SERVER_ADDRESS + ':' + str(PORT)
         #self.block_server = xmlrpc.client.ServerProxy(server_url, use_builtin_types=True)
         socket.setdefaulttimeout(fsconfig.SOCKET_TIMEOUT)
-        # initialize block cache empty
-        self.bcache = []
+        if fsconfig.BACKEND == 'local':
+            # local servers answer at once: calls run in the calling thread
+            self.io = InlineIO()
+        else:
+            # one worker thread per server runs all calls to that server, so calls to different servers overlap
+            self.io = ParallelIO(fsconfig.NUM_SERVERS)
+        self.lock_location = self.layout.Locate(fsconfig.TOTAL_NUM_BLOCKS - 1)
+        self.zero_block = bytes(fsconfig.BLOCK_SIZE)
+        # up/suspect/down/stale state of each server; suspect and down servers are probed in the background
+        self.health = ServerHealth(fsconfig.NUM_SERVERS, self.layout.max_failures > 0)
+        self.health.StartProbes(self.ProbeServer, fsconfig.PROBE_INTERVAL)
+        # requests, queue depth and response time of each server; reads are balanced on them (see ReadLocation)
+        self.load = ServerLoad(fsconfig.NUM_SERVERS, fsconfig.READ_BALANCE_WEIGHT, fsconfig.READ_BALANCE_FACTOR)
+        # initialize block cache empty; it keeps at most CACHE_CAPACITY blocks
+        self.bcache = BlockCache(fsconfig.CACHE_CAPACITY)
+        # per server: the server version up to which changes have been checked, and the versions of this
+        # client's own writes since then, {level: version} (see InvalidateChanged)
+        self.seen_versions = [0] * fsconfig.NUM_SERVERS
+        # epoch of each server when its changes were last checked; None before the first check
+        self.server_epochs = [None] * fsconfig.NUM_SERVERS
+        self.written_versions = []
         for i in range(fsconfig.NUM_SERVERS):
-            self.bcache.append({})
+            self.written_versions.append({})
+        # write-back cache: blocks written while holding the lock, {block_number: data}, see WriteBack
+        self.dirty = {}
+        # True while this client holds the lock in exclusive mode, i.e. may write
+        self.lock_held = False
+        # last writer as read at Acquire, and whether this client wrote blocks while holding the lock
+        self.last_writer = None
+        self.wrote_blocks = False
+        # the servers' lock service is used until a server turns out not to have it; then the RSM lock block
+        self.lock_service = True
+        self.lock_token = 0
+        # when the lease of the lock was granted or last renewed (see CheckLease)
+        self.lease_start = 0
+        # request ids of requests that XOR deltas (see RequestId)
+        self.session = random.getrandbits(31)
+        self.request_sequences = [0] * fsconfig.NUM_SERVERS
+
+    ## Returns connection statistics (requests, reuses, connects, reconnects) for each server
+
+    def ConnectionStats(self):
+        stats = []
+        for connection in self.connections:
+            stats.append(connection.Stats())
+        return stats
+
+    ## Returns block cache statistics (hits, misses, evictions, blocks cached)
+
+    def CacheStats(self):
+        return self.bcache.Stats()
+
+    ## The RSM lock block is test-and-set on the server without going through Put, so its contents are
+    ## never cached and it is kept out of the redundancy (it always contributes zeroes, i.e. RSM_UNLOCKED)
+
+    def IsLockBlock(self, server_number, level):
+        return self.lock_location == (server_number, level)
+
+    ## CallWithRetry: calls an RPC method (e.g. 'Put', 'GetMany') on one block server, retrying while it times out
+    ## Returns the result of the call, or None if the server is disconnected
+    ## A server that could not be connected to is marked down and not called again until a probe finds it
+    ## answering, so callers reconstruct its blocks (or update parity only) without paying for a failed call.
+    ## Reads of a stale server are not sent either, so its blocks are reconstructed until it is repaired
+    ## This runs on the worker thread of server_number, see ServerCall and ServerCalls
+
+    def CallWithRetry(self, server_number, method, args):
+        if self.health.IsDown(server_number):
+            return None
+        if method in ('Get', 'GetMany') and not self.health.IsReadable(server_number):
+            return None
+        rpcretry = True
+        while rpcretry:
+            rpcretry = False
+            try:
+                start = time.time()
+                result = getattr(self.server_list[server_number], method)(*args)
+                # LockAcquire waits on the server for the lock, which says nothing about the server's load
+                if method != 'LockAcquire':
+                    self.load.Record(server_number, time.time() - start)
+                if self.health.State(server_number) == blockio.SUSPECT:
+                    self.health.Mark(server_number, blockio.UP)
+                return self.ExpandZeroes(method, result)
+            except (socket.timeout, ConnectionRefusedError, xmlrpc.client.ProtocolError) as err:
+                if isinstance(err, socket.timeout):
+                    print("SERVER_TIMED_OUT")
+                    self.health.Mark(server_number, blockio.SUSPECT)
+                    time.sleep(fsconfig.RETRY_INTERVAL)
+                    rpcretry = True
+                else:
+                    print("DISCONNECTED " + method.upper() + " SERVER NUMBER: ", str(server_number))
+                    self.health.Mark(server_number, blockio.DOWN)
+        return None
+
+    ## Servers send ZERO_BLOCK instead of a block of zeroes (see blockprotocol.py); it becomes self.zero_block,
+    ## one read-only block shared by all reads and cache entries of zero blocks
+
+    def ExpandZeroes(self, method, result):
+        if method == 'Get' and result == ZERO_BLOCK:
+            return self.zero_block
+        if method == 'GetMany':
+            return [self.zero_block if block == ZERO_BLOCK else block for block in result]
+        return result
+
+    ## ProbeServer: checks whether a server that is not up answers a minimal request; returns its new state
+    ## Runs on the server's worker thread, like its other calls
+
+    def ProbeServer(self, server_number):
+        return self.io.Submit(server_number, self.Probe, server_number).result()
+
+    def Probe(self, server_number):
+        try:
+            self.server_list[server_number].GetMany([])
+            return blockio.UP
+        except socket.timeout:
+            return blockio.SUSPECT
+        except (OSError, xmlrpc.client.ProtocolError):
+            return blockio.DOWN
+
+    ## Returns the state (up, suspect, down) of each server
+
+    def ServerStates(self):
+        return [self.health.State(i) for i in range(0, fsconfig.NUM_SERVERS)]
+
+    ## Returns load statistics (requests, queued, latency_ms, offloaded) for each server
+
+    def LoadStats(self):
+        return self.load.Stats()
+
+    ## ServerCall: calls an RPC method on one block server and waits for the result (None if disconnected)
+
+    def ServerCall(self, server_number, method, *args):
+        self.load.Submit(server_number)
+        return self.io.Submit(server_number, self.QueuedCall, server_number, method, args).result()
+
+    ## ServerCalls: runs a list of (server_number, method, args) RPCs concurrently across servers
+    ## Returns the results in the order of calls (None for a disconnected server)
+
+    def ServerCalls(self, calls):
+        parallel_calls = []
+        for server_number, method, args in calls:
+            self.load.Submit(server_number)
+            parallel_calls.append((server_number, self.QueuedCall, (server_number, method, args)))
+        return self.io.Run(parallel_calls)
+
+    ## QueuedCall: CallWithRetry of a call counted as queued on its server (see ServerLoad) from its submission
+    ## until it completes
+
+    def QueuedCall(self, server_number, method, args):
+        try:
+            return self.CallWithRetry(server_number, method, args)
+        finally:
+            self.load.Complete(server_number)
+
+    ## Remembers the version a server gave to this client's write, so it is not taken for another client's
+    ## write by InvalidateChanged. version is None if the server is disconnected
+
+    def RecordWrite(self, server_number, level, version):
+        if version is not None:
+            self.written_versions[server_number][level] = version
+
+    ## RequestId: the id of a new request to server_number that XORs deltas into blocks. Applying a delta twice
+    ## corrupts the block, so the server applies a request once and answers a retry of it with the first result
+    ## (see blockserver.DiskBlocks.Once). The session tells this client apart from an earlier run with the same CID
+
+    def RequestId(self, server_number):
+        self.request_sequences[server_number] += 1
+        return [fsconfig.CID, self.session, self.request_sequences[server_number]]
+
+    ## Write-back cache (CACHE_POLICY 'writeback'): while this client holds the lock, Put and PutBlocks only
+    ## record the new data in self.dirty, so repeated writes to a block are merged. Release flushes the dirty
+    ## blocks in one batch (data plus parity) before dropping the lock, so other clients, which read the
+    ## servers after Acquire, always see them. bcache keeps holding the servers' contents, which parity
+    ## read-modify-write needs; reads look at self.dirty first.
+    ## The lock and LAST_WRITER blocks are always written through.
+
+    def WriteBack(self, block_number):
+        return fsconfig.CACHE_POLICY == 'writeback' and self.lock_held and block_number < fsconfig.TOTAL_NUM_BLOCKS-2
+
+    ## Flush: writes all dirty blocks to the servers
+
+    def Flush(self):
+        if len(self.dirty) == 0:
+            return 0
+        blocks = list(self.dirty.items())
+        self.dirty = {}
+        return self.WriteBlocks(blocks)
+
+    ## Flags this client as the last writer in the LAST_WRITER block
+
+    def FlagLastWriter(self):
+        LAST_WRITER_BLOCK = fsconfig.TOTAL_NUM_BLOCKS - 2
+        updated_block = bytearray(fsconfig.BLOCK_SIZE)
+        updated_block[0] = fsconfig.CID
+        self.WriteBlocks([(LAST_WRITER_BLOCK, updated_block)])
+        self.last_writer = fsconfig.CID
+
+    ## Called after blocks other than the lock and LAST_WRITER blocks were written
+    ## While holding the lock, the last writer is flagged once, in Release; other writes flag it at once
+
+    def NoteWrite(self):
+        if self.lock_held:
+            self.wrote_blocks = True
+        else:
+            self.FlagLastWriter()
 
     ## Put: interface to write a raw block of data to the block indexed by block number
     ## Blocks are padded with zeroes up to BLOCK_SIZE
@@ -45,106 +274,289 @@ class DiskBlocks():
 
         if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
             # ljust does the padding with zeros
-            parity_server_number = (block_number//(fsconfig.NUM_SERVERS-1))%fsconfig.NUM_SERVERS  #parity server number
-            parity_level = block_number//(fsconfig.NUM_SERVERS-1)                                #parity level
-            data_block_level = block_number//(fsconfig.NUM_SERVERS-1)                             #data_block level
-            server_number = block_number%(fsconfig.NUM_SERVERS-1)                                   #level for data_block
-            if server_number >= (data_block_level%fsconfig.NUM_SERVERS):
-                server_number+=1
-            
             putdata = bytearray(block_data.ljust(fsconfig.BLOCK_SIZE, b'\x00'))
-            self.bcache[server_number][data_block_level] = putdata
-            
-            # Write block
-
-            # commenting this out as the request now goes to the server
-            # self.block[block_number] = putdata
-            # call Put() method on the server; code currently quits on any server failure
-            rpcretry = True
-            while rpcretry:
-                rpcretry = False
-                try:
-                    self.server_list[server_number].Put(data_block_level,putdata)
-                except (socket.timeout, ConnectionRefusedError ,xmlrpc.client.ProtocolError) as err:
-                    
-                    if err == socket.timeout:
-                        print("SERVER_TIMED_OUT")
-                        time.sleep(fsconfig.RETRY_INTERVAL)
-                        rpcretry = True
-                    else:
-                        print("DISCONNECTED PUT SERVER NUMBER: ",str(server_number))
-            #PARITY UPDATE
-            rpcretry = True
-            while rpcretry:
-                rpcretry = False
-                try:
-                    curr_parity_data = self.Get(parity_level, parity_server_number)
-                    par_result = bytearray(a ^ b for a, b in zip(curr_parity_data, putdata))
-                    self.server_list[parity_server_number].Put(parity_level ,par_result)
-                except (socket.timeout, ConnectionRefusedError ,xmlrpc.client.ProtocolError) as err:
-                    
-                    if err == socket.timeout:
-                        print("SERVER_TIMED_OUT")
-                        time.sleep(fsconfig.RETRY_INTERVAL)
-                        rpcretry = True
-                    else:
-                        print("DISCONNECTED PUT SERVER NUMBER: ",str(parity_server_number))
-            # update block cache
-            if fsconfig.LOGCACHE == 1: print('CACHE_WRITE_THROUGH ' + str(block_number))
-
-            
-            
-            # flag this s the last writer
-            # unless this is a release - which doesn't flag last writer
-            if block_number != fsconfig.TOTAL_NUM_BLOCKS-1:
-                LAST_WRITER_BLOCK = fsconfig.TOTAL_NUM_BLOCKS - 2
-                lwb_parity_server_number = (LAST_WRITER_BLOCK//(fsconfig.NUM_SERVERS-1))%fsconfig.NUM_SERVERS  #parity server number
-                lwb_parity_level = LAST_WRITER_BLOCK//(fsconfig.NUM_SERVERS-1)                                 #parity level
-                lwb_data_block_level = LAST_WRITER_BLOCK//(fsconfig.NUM_SERVERS-1)                             #data_block level
-                lwb_server_number = LAST_WRITER_BLOCK % (fsconfig.NUM_SERVERS-1)                                   #level for data_block
-                if lwb_server_number >= (lwb_data_block_level%fsconfig.NUM_SERVERS):
-                    lwb_server_number+=1
-
-                updated_block = bytearray(fsconfig.BLOCK_SIZE)
-                updated_block[0] = fsconfig.CID
-                
-                rpcretry = True
-                while rpcretry:
-                    rpcretry = False
-                    try:
-                        self.server_list[lwb_server_number].Put(lwb_data_block_level, updated_block)
-                    except (socket.timeout,ConnectionRefusedError, xmlrpc.client.ProtocolError) as err:
-                        
-                        if err == socket.timeout:
-                            print("SERVER_TIMED_OUT")
-                            time.sleep(fsconfig.RETRY_INTERVAL)
-                            rpcretry = True
-
-                        else:
-                            print("DISCONNECTED PUT SERVER NUMBER: ", str(lwb_server_number))
-                
-                rpcretry = True
-                while rpcretry:
-                    rpcretry = False
-                    try:
-                        curr_parity_data = self.Get(lwb_parity_level, lwb_parity_server_number)
-                        par_result = bytearray(a ^ b for a, b in zip(curr_parity_data, updated_block))
-                        self.server_list[lwb_parity_server_number].Put(lwb_parity_level ,par_result)
-                    except (socket.timeout,ConnectionRefusedError, xmlrpc.client.ProtocolError) as err:
-                        
-                        if err == socket.timeout:
-                            print("SERVER_TIMED_OUT")
-                            time.sleep(fsconfig.RETRY_INTERVAL)
-                            rpcretry = True
-
-                        else:
-                            print("DISCONNECTED PUT SERVER NUMBER: ", str(parity_server_number))
-                
+            if self.WriteBack(block_number):
+                self.dirty[block_number] = putdata
+                if fsconfig.LOGCACHE == 1: print('CACHE_WRITE_BACK ' + str(block_number))
+                return 0
+            # write data block and redundancy, flagging this as the last writer unless this is the lock or
+            # last writer block; the block cache is updated on the way
+            self.WriteBlocks([(block_number, putdata)])
             return 0
         else:
             logging.error('Put: Block out of range: ' + str(block_number))
             quit()
 
+    ## ReadLevels: reads raw blocks given as a dict {server_number: [levels]}
+    ## Cached blocks are served from bcache; the others are read with one GetMany per server, and the
+    ## GetMany calls to different servers run in parallel. The blocks of a disconnected server are
+    ## reconstructed from the same levels of its peers, again read in parallel. With reconstruct False,
+    ## blocks that cannot be read are left out of the result instead
+    ## Returns a dict {(server_number, level): bytearray}
+
+    def ReadLevels(self, wanted, reconstruct = True):
+        result = {}
+        misses = {}
+        for server_number in wanted:
+            for level in wanted[server_number]:
+                cached = None
+                if not self.IsLockBlock(server_number, level):
+                    cached = self.bcache.Lookup(server_number, level)
+                if cached is not None:
+                    if fsconfig.LOGCACHE == 1: print('CACHE_HIT '+ str(level))
+                    result[(server_number, level)] = cached
+                elif level not in misses.setdefault(server_number, []):
+                    if fsconfig.LOGCACHE == 1: print('CACHE_MISS ' + str(level))
+                    misses[server_number].append(level)
+        fetch_servers = [server_number for server_number in misses if len(misses[server_number]) > 0]
+        offloaded = {}
+        if reconstruct:
+            for server_number in [i for i in fetch_servers if self.Offload(i, misses[i])]:
+                data = self.Rebuild(server_number, misses[server_number])
+                if data is not None:
+                    offloaded[server_number] = data
+                    fetch_servers.remove(server_number)
+        fetched = self.ServerCalls([(server_number, 'GetMany', (misses[server_number],)) for server_number in fetch_servers])
+
+        for server_number, data in list(zip(fetch_servers, fetched)) + list(offloaded.items()):
+            levels = misses[server_number]
+            if data is None:
+                if not reconstruct:
+                    continue
+                data = self.Reconstruct(server_number, levels)
+            elif CORRUPT in data and reconstruct:
+                # blocks that failed the server's checksum are rebuilt from redundancy and written back
+                corrupted = [level for level, block in zip(levels, data) if block == CORRUPT]
+                rebuilt = dict(zip(corrupted, self.Reconstruct(server_number, corrupted)))
+                self.Heal(server_number, list(rebuilt.items()))
+                data = [rebuilt.get(level, block) for level, block in zip(levels, data)]
+            for level, block in zip(levels, data):
+                if block == CORRUPT:
+                    continue
+                # zero blocks stay the shared read-only block; callers get copies (see Get and GetBlocks)
+                result[(server_number, level)] = block if block is self.zero_block else bytearray(block)
+                # add to cache
+                if not self.IsLockBlock(server_number, level):
+                    self.bcache.Insert(server_number, level, result[(server_number, level)])
+        return result
+
+    ## Parity-assisted reads (READ_BALANCE 'on'): while every server is up, the blocks of a server that is
+    ## hot, i.e. much slower to answer than the others (see blockio.ServerLoad), are rebuilt from the other
+    ## servers of their stripes instead of read from it, so a hot block such as the inode table does not
+    ## queue all reads on one server. Mirrored layouts balance in ReadLocation instead
+
+    def Offload(self, server_number, levels):
+        if fsconfig.READ_BALANCE != 'on' or self.layout.max_failures == 0:
+            return False
+        if len(self.layout.Copies(server_number, levels[0])) > 1:
+            return False
+        if any(self.IsLockBlock(server_number, level) for level in levels):
+            return False
+        if any(state != blockio.UP for state in self.ServerStates()):
+            return False
+        return self.load.Offload(server_number)
+
+    ## ReadLocation: returns the (server_number, level) to read a block from: where the layout stores it or,
+    ## with READ_BALANCE 'on' and copies of the block on several servers (RAID-1), an up copy that is
+    ## cached or else one of the least loaded (see blockio.ServerLoad.Pick). The lock block is only read
+    ## where it is tested and set
+
+    def ReadLocation(self, block_number):
+        server_number, level = self.layout.Locate(block_number)
+        if fsconfig.READ_BALANCE != 'on' or self.IsLockBlock(server_number, level):
+            return server_number, level
+        copies = [i for i in self.layout.Copies(server_number, level) if self.health.State(i) == blockio.UP]
+        if len(copies) <= 1:
+            return server_number, level
+        for i in copies:
+            if self.bcache.Contains(i, level):
+                return i, level
+        return self.load.Pick(copies), level
+
+    ## Reconstruct: rebuilds the blocks of server_number at the given stripe levels from the other servers'
+    ## blocks of each level (see blocklayout), read from all of them in parallel. Servers known to be down, and
+    ## blocks that cannot be read, count as missing too; the lock block is not in the redundancy
+
+    def Reconstruct(self, server_number, levels):
+        data = self.Rebuild(server_number, levels)
+        if data is None:
+            quit()
+        return data
+
+    ## Rebuild: Reconstruct, returning None if a level cannot be rebuilt
+
+    def Rebuild(self, server_number, levels):
+        missing = [server_number]
+        for i in range(0, fsconfig.NUM_SERVERS):
+            if i != server_number and not self.health.IsReadable(i):
+                missing.append(i)
+        peers = {}
+        for i in range(0, fsconfig.NUM_SERVERS):
+            if i not in missing:
+                peers[i] = [level for level in levels if not self.IsLockBlock(i, level)]
+        peer_blocks = self.ReadLevels(peers, reconstruct = False)
+        data = []
+        for level in levels:
+            blocks = {}
+            lost = list(missing)
+            for i in peers:
+                if (i, level) in peer_blocks:
+                    blocks[i] = peer_blocks[(i, level)]
+                elif not self.IsLockBlock(i, level):
+                    lost.append(i)
+            recovered = self.layout.Recover(level, blocks, lost)
+            if recovered is None:
+                logging.error('Reconstruct: cannot rebuild level ' + str(level) + ' of server ' + str(server_number)
+                              + ', blocks missing on servers ' + str(lost))
+                return None
+            data.append(recovered[0])
+        return data
+
+    ## Checksums: a server returns CORRUPT in place of a block that does not match its checksum (see
+    ## blockserver.DiskBlocks). Reads rebuild such a block from redundancy, so the damage never reaches a caller
+    ## or, through read-modify-write, the stripe's parity; Heal then writes the rebuilt block back over the bad copy
+
+    def Heal(self, server_number, blocks):
+        print('CORRUPTED BLOCK SERVER NUMBER: ' + str(server_number) + ' LEVELS: ' + str([level for level, data in blocks]))
+        versions = self.ServerCall(server_number, 'PutMany', blocks)
+        if versions is not None:
+            for (level, data), version in zip(blocks, versions):
+                self.RecordWrite(server_number, level, version)
+
+    ## GetBlocks: reads several blocks with one round trip per server instead of one per block
+    ## Returns a list of bytearrays in the order of block_numbers
+
+    def GetBlocks(self, block_numbers):
+
+        logging.debug('GetBlocks: ' + str(block_numbers))
+        wanted = {}
+        locations = {}
+        for block_number in block_numbers:
+            if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                logging.error('GetBlocks: Block number larger than TOTAL_NUM_BLOCKS: ' + str(block_number))
+                quit()
+            if block_number in self.dirty or block_number in locations:
+                continue
+            server_number, level = locations[block_number] = self.ReadLocation(block_number)
+            wanted.setdefault(server_number, []).append(level)
+        blocks = self.ReadLevels(wanted)
+        # return copies as bytearray, as Get does
+        result = []
+        for block_number in block_numbers:
+            if block_number in self.dirty:
+                result.append(bytearray(self.dirty[block_number]))
+            else:
+                result.append(bytearray(blocks[locations[block_number]]))
+        return result
+
+    ## PutBlocks: writes several blocks, given as a list of (block_number, block_data)
+    ## With the write-back cache, blocks written while holding the lock are only marked dirty
+
+    def PutBlocks(self, blocks):
+
+        logging.debug('PutBlocks: ' + str([block_number for block_number, block_data in blocks]))
+        write_through = []
+        for block_number, block_data in blocks:
+            if len(block_data) > fsconfig.BLOCK_SIZE:
+                logging.error('PutBlocks: Block larger than BLOCK_SIZE: ' + str(len(block_data)))
+                quit()
+            if block_number not in range(0, fsconfig.TOTAL_NUM_BLOCKS):
+                logging.error('PutBlocks: Block out of range: ' + str(block_number))
+                quit()
+            putdata = bytearray(bytes(block_data).ljust(fsconfig.BLOCK_SIZE, b'\x00'))
+            if self.WriteBack(block_number):
+                self.dirty[block_number] = putdata
+                if fsconfig.LOGCACHE == 1: print('CACHE_WRITE_BACK ' + str(block_number))
+            else:
+                write_through.append((block_number, putdata))
+        if len(write_through) > 0:
+            self.WriteBlocks(write_through)
+        return 0
+
+    ## WriteBlocks: writes several padded blocks, given as a list of (block_number, data), with one round trip
+    ## per server for the old data (if needed) and one per server for the new data and redundancy
+    ## Stripe levels that are written whole get their redundancy from the new data (see blocklayout); others
+    ## use read-modify-write, e.g. for RAID-5: new_parity = old_parity ^ old_data ^ new_data, where the client
+    ## sends old_data ^ new_data and the parity server XORs it in (XorPutMany), so the parity is never read
+    ## Old blocks are taken from bcache when present. If a data server is down, its old block is reconstructed
+    ## and the new data lives in the redundancy
+
+    def WriteBlocks(self, blocks):
+
+        self.CheckLease()
+        # group blocks by stripe level, {level: {server_number: (block_number, data)}}; a later write to the
+        # same block replaces an earlier one
+        stripes = {}
+        for block_number, putdata in blocks:
+            server_number, level = self.layout.Locate(block_number)
+            stripes.setdefault(level, {})[server_number] = (block_number, putdata)
+
+        # find the levels that need read-modify-write, and read their old data in one batch (the lock block is
+        # not in the redundancy, so writing it alone does not). Their redundancy is not read: the servers
+        # XOR the change into it (XorPutMany)
+        wanted = {}
+        partial_levels = set()
+        for level in stripes:
+            redundancy_servers = self.layout.Row(level)[1]
+            data_servers = [i for i in stripes[level] if not self.IsLockBlock(i, level)]
+            if len(redundancy_servers) == 0 or len(data_servers) == 0 or self.layout.IsFullRow(level, stripes[level]):
+                continue
+            partial_levels.add(level)
+            for server_number in data_servers:
+                wanted.setdefault(server_number, []).append(level)
+        old_blocks = self.ReadLevels(wanted)
+
+        # compute new redundancy (or its change) per level and collect all writes per server
+        writes = {}
+        xors = {}
+        for level in stripes:
+            new = {}
+            for server_number, (block_number, putdata) in stripes[level].items():
+                writes.setdefault(server_number, []).append((level, putdata))
+                if self.IsLockBlock(server_number, level):
+                    continue
+                new[server_number] = putdata
+                self.bcache.Insert(server_number, level, putdata)
+                if fsconfig.LOGCACHE == 1: print('CACHE_WRITE_THROUGH ' + str(block_number))
+            redundancy_servers = self.layout.Row(level)[1]
+            if len(redundancy_servers) == 0 or len(new) == 0:
+                continue
+            if level in partial_levels:
+                old = {}
+                for server_number in new:
+                    old[server_number] = old_blocks[(server_number, level)]
+                for server_number, delta in zip(redundancy_servers, self.layout.Delta(level, old, new)):
+                    # the new redundancy block is only known to the server
+                    self.bcache.Invalidate(server_number, level)
+                    xors.setdefault(server_number, []).append((level, delta))
+            else:
+                for server_number, block in zip(redundancy_servers, self.layout.Encode(level, new)):
+                    self.bcache.Insert(server_number, level, block)
+                    writes.setdefault(server_number, []).append((level, block))
+        # one request per server: PutMany, with the deltas of a server that also gets new blocks. Requests with
+        # deltas get a request id, so CallWithRetry can resend them after a timeout (see RequestId)
+        calls = []
+        for server_number in set(writes) | set(xors):
+            if server_number not in writes:
+                calls.append((server_number, 'XorPutMany', (xors[server_number], False, self.RequestId(server_number))))
+            elif server_number not in xors:
+                calls.append((server_number, 'PutMany', (writes[server_number],)))
+            else:
+                calls.append((server_number, 'PutMany', (writes[server_number], xors[server_number], self.RequestId(server_number))))
+        results = self.ServerCalls(calls)
+        for (server_number, method, args), versions in zip(calls, results):
+            if versions is None:
+                continue
+            written = writes.get(server_number, []) + xors.get(server_number, [])
+            for (level, putdata), version in zip(written, versions):
+                self.RecordWrite(server_number, level, version)
+
+        # flag this as the last writer, unless only the lock or last writer blocks were written
+        for block_number, putdata in blocks:
+            if block_number < fsconfig.TOTAL_NUM_BLOCKS-2:
+                self.NoteWrite()
+                break
+        return 0
 
     ## Get: interface to read a raw block of data from block indexed by block number
     ## Equivalent to the textbook's BLOCK_NUMBER_TO_BLOCK(b)
@@ -158,43 +570,34 @@ class DiskBlocks():
             # commenting this out as the request now goes to the server
             # return self.block[block_number]
             # call Get() method on the server
-            # don't look up cache for last two blocks
+            # don't look up cache for the RSM lock block
             data=None
+            if server_number == None and block_number in self.dirty:
+                return bytearray(self.dirty[block_number])
             if server_number == None:
-                get_block_number = block_number//(fsconfig.NUM_SERVERS-1)                             #data_block level
-                get_target_server_number = block_number%(fsconfig.NUM_SERVERS-1)                                   #level for data_block
-                if get_target_server_number >= (get_block_number% fsconfig.NUM_SERVERS):
-                    get_target_server_number+=1
-                block_number = get_block_number
-                server_number = get_target_server_number
-            if (block_number < fsconfig.TOTAL_NUM_BLOCKS-2) and (block_number in self.bcache[server_number]):
+                server_number, block_number = self.ReadLocation(block_number)
+            if not self.IsLockBlock(server_number, block_number):
+                data = self.bcache.Lookup(server_number, block_number)
+            if data is not None:
                 if fsconfig.LOGCACHE == 1: print('CACHE_HIT '+ str(block_number))
-                data = self.bcache[server_number][block_number]
             else:
                 if fsconfig.LOGCACHE == 1: print('CACHE_MISS ' + str(block_number))
-                rpcretry = True
-                while rpcretry:
-                    rpcretry = False
-                    try:
-                        data = self.server_list[server_number].Get(block_number)
-                        break
-                    except (socket.timeout, xmlrpc.client.ProtocolError, ConnectionRefusedError) as err:
-                        
-                        if err == socket.timeout:
-                            print("SERVER_TIMED_OUT")
-                            time.sleep(fsconfig.RETRY_INTERVAL)
-                            rpcretry = True
-                        else:
-                            print("DISCONNECTED GET SERVER NUMBER: ",server_number)
-                            ret = bytearray(fsconfig.BLOCK_SIZE)
-                            for i in range(fsconfig.NUM_SERVERS):
-                                if i==server_number:
-                                    continue
-                                curr_data = self.Get(block_number,i)
-                                ret = bytearray(a ^ b for a, b in zip(ret, curr_data))
-                            data = ret
+                data = None
+                if self.Offload(server_number, [block_number]):
+                    data = self.Rebuild(server_number, [block_number])
+                if data is not None:
+                    data = data[0]
+                else:
+                    data = self.ServerCall(server_number, 'Get', block_number)
+                if data is None:
+                    # reconstruct from the surviving blocks of the stripe, read from all peers in parallel
+                    data = self.Reconstruct(server_number, [block_number])[0]
+                elif data == CORRUPT:
+                    data = self.Reconstruct(server_number, [block_number])[0]
+                    self.Heal(server_number, [(block_number, data)])
                 # add to cache
-                self.bcache[server_number][block_number] = data
+                if not self.IsLockBlock(server_number, block_number):
+                    self.bcache.Insert(server_number, block_number, data)
             # return as bytearray
             return bytearray(data)
 
@@ -202,128 +605,432 @@ class DiskBlocks():
         quit()
 
 ## Repair procedure:
+    ## repair: rebuilds every stripe level of server_number (e.g. a replaced, empty server) from its peers
+    ## Levels are rebuilt in batches of REPAIR_BATCH: one GetMany per peer, all read in parallel and
+    ## bypassing the block cache, the XOR of each level, then one PutMany to the server being rebuilt.
+    ## Each batch holds the lock, so no client changes a stripe while it is rebuilt and foreground
+    ## commands run between batches; REPAIR_RATE (MB/s, 0: no limit) throttles the rebuild further.
+    ## The next level to rebuild is saved in a progress file after each batch, with the server's epoch, so an
+    ## interrupted repair resumes there unless the server restarted since (and may have lost the rebuilt levels).
+    ## Returns 0 when done, -1 if too many peers could not be read or the server could not be written
+
     def repair(self, server_number):
         logging.debug('Repair: by RAID 5' + str(server_number))
-        # helper_server = -1
-        # for server in range(0,fsconfig.NUM_SERVERS):
-        #     if server!=server_number:
-        #         helper_server=server
-        #         break
-        # for blockno in range(0,fsconfig.TOTAL_NUM_BLOCKS):
-        #     data = self.server_list[helper_server].Get(blockno)
-        #     self.server_list[server_number].Put(blockno,data)
-        for levels in range(0,(fsconfig.TOTAL_NUM_BLOCKS//(fsconfig.NUM_SERVERS-1))  ):
-            data = bytearray(fsconfig.BLOCK_SIZE)
-            for i in range(0,fsconfig.NUM_SERVERS):
-                if i==server_number:
+        num_levels = self.NumLevels()
+        progress_file = 'repair_server' + str(server_number) + '.progress'
+        # blocks cached from the server before it failed are not needed any more. The server is back, so it
+        # is written again, but its blocks are only read once it is rebuilt: it stays stale until then
+        self.bcache.InvalidateServer(server_number)
+        if self.layout.max_failures == 0:
+            print('Repair: RAID-' + str(fsconfig.RAID_LEVEL) + ' keeps no redundancy, server ' + str(server_number) + ' cannot be rebuilt')
+            return -1
+        if self.health.State(server_number) != blockio.UP:
+            self.health.Mark(server_number, blockio.STALE)
+        epoch = self.ServerCall(server_number, 'Epoch')
+        if epoch is None:
+            print('Repair: cannot reach server ' + str(server_number))
+            return -1
+        level = self.ReadRepairProgress(progress_file, server_number, num_levels, epoch)
+        if level > 0:
+            print('Repair: resuming server ' + str(server_number) + ' at stripe level ' + str(level))
+        peers = [i for i in range(0, fsconfig.NUM_SERVERS) if i != server_number]
+        rebuilt = 0
+        start = time.time()
+        while level < num_levels:
+            levels = list(range(level, min(level + fsconfig.REPAIR_BATCH, num_levels)))
+            self.Acquire()
+            peer_blocks = self.ServerCalls([(i, 'GetMany', (levels,)) for i in peers])
+            blocks = []
+            for k in range(0, len(levels)):
+                # the lock block is not in the redundancy; blocks of disconnected peers and corrupted blocks
+                # are missing too
+                available = {}
+                missing = [server_number]
+                for i, data in zip(peers, peer_blocks):
+                    if data is None or data[k] == CORRUPT:
+                        missing.append(i)
+                    elif not self.IsLockBlock(i, levels[k]):
+                        available[i] = data[k]
+                recovered = self.layout.Recover(levels[k], available, missing)
+                if recovered is None:
+                    self.Release()
+                    print('Repair: cannot rebuild stripe level ' + str(levels[k]) + ', blocks missing on servers ' + str(missing))
+                    return -1
+                blocks.append((levels[k], recovered[0]))
+            versions = self.ServerCall(server_number, 'PutMany', blocks)
+            self.Release()
+            if versions is None or len(versions) != len(blocks):
+                # the progress file still points at this batch: a later repair resumes there if the server
+                # did not restart meanwhile
+                print('Repair: cannot write server ' + str(server_number) + ', stopped at stripe level ' + str(level))
+                return -1
+            level = levels[-1] + 1
+            rebuilt += len(levels)
+            self.WriteRepairProgress(progress_file, server_number, num_levels, epoch, level)
+            self.Throttle(start, rebuilt * fsconfig.BLOCK_SIZE, fsconfig.REPAIR_RATE)
+        # a server that restarted between two batches lost the levels rebuilt before; the progress file has
+        # its old epoch, so the next repair starts over
+        if self.ServerCall(server_number, 'Epoch') != epoch:
+            print('Repair: server ' + str(server_number) + ' restarted during the repair, stopped')
+            return -1
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+        self.health.Mark(server_number, blockio.UP)
+        elapsed = max(time.time() - start, 1e-9)
+        print('Repair: rebuilt server ' + str(server_number) + ': ' + str(rebuilt) + ' blocks in ' + '%.3f' % elapsed
+              + ' s, ' + '%.2f' % (rebuilt * fsconfig.BLOCK_SIZE / elapsed / 1e6) + ' MB/s')
+        return 0
+
+    ## Throttle: sleeps until moving num_bytes since start took at least as long as rate (MB/s, 0: no limit) allows
+
+    def Throttle(self, start, num_bytes, rate):
+        if rate > 0:
+            ahead = num_bytes / (rate * 1e6) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    ## scrub: checks that the redundancy blocks of every stripe level (e.g. the RAID-5 parity, the XOR of the
+    ## data blocks) match its data blocks. Levels are read in batches of REPAIR_BATCH, one GetMany per server in parallel and
+    ## bypassing the block cache; each batch holds the lock (shared, unless fixing) and SCRUB_RATE (MB/s read,
+    ## 0: no limit) throttles the scrub. With fix, the redundancy of a mismatched level is rewritten from its
+    ## data. Blocks that fail their server's checksum are rebuilt from the rest of their stripe and written back.
+    ## Returns the list of mismatched levels, or None if a server could not be read
+
+    def scrub(self, fix = False):
+        logging.debug('Scrub: fix ' + str(fix))
+        num_levels = self.NumLevels()
+        mismatched = []
+        healed = 0
+        level = 0
+        start = time.time()
+        while level < num_levels:
+            levels = list(range(level, min(level + fsconfig.REPAIR_BATCH, num_levels)))
+            self.Acquire(shared = not fix)
+            stripes = self.ServerCalls([(i, 'GetMany', (levels,)) for i in range(0, fsconfig.NUM_SERVERS)])
+            if None in stripes:
+                self.Release()
+                print('Scrub: cannot read all servers, stopped at stripe level ' + str(level))
+                return None
+            parity_writes = {}
+            for k in range(0, len(levels)):
+                # the lock block is not in the redundancy
+                blocks = {}
+                for i in range(0, fsconfig.NUM_SERVERS):
+                    if not self.IsLockBlock(i, levels[k]):
+                        blocks[i] = stripes[i][k]
+                corrupted = [i for i in blocks if blocks[i] == CORRUPT]
+                if len(corrupted) > 0:
+                    for i in corrupted:
+                        del blocks[i]
+                    recovered = self.layout.Recover(levels[k], blocks, corrupted)
+                    if recovered is None:
+                        logging.error('Scrub: cannot rebuild stripe level ' + str(levels[k]) + ', corrupted on servers ' + str(corrupted))
+                        mismatched.append(levels[k])
+                        continue
+                    for i, block in zip(corrupted, recovered):
+                        self.Heal(i, [(levels[k], block)])
+                    healed += len(corrupted)
                     continue
-                curr_data = self.Get(levels,i)
-                data = bytearray(a ^ b for a, b in zip(data, curr_data))
+                data_servers, redundancy_servers = self.layout.Row(levels[k])
+                data = {}
+                for i in data_servers:
+                    if i in blocks:
+                        data[i] = blocks[i]
+                expected = self.layout.Encode(levels[k], data)
+                bad = [(i, block) for i, block in zip(redundancy_servers, expected) if block != blocks[i]]
+                if len(bad) > 0:
+                    mismatched.append(levels[k])
+                    if fix:
+                        for i, block in bad:
+                            parity_writes.setdefault(i, []).append((levels[k], block))
+            if len(parity_writes) > 0:
+                write_servers = list(parity_writes)
+                results = self.ServerCalls([(i, 'PutMany', (parity_writes[i],)) for i in write_servers])
+                for server_number, versions in zip(write_servers, results):
+                    for (parity_level, parity), version in zip(parity_writes[server_number], versions or []):
+                        self.bcache.Insert(server_number, parity_level, parity)
+                        self.RecordWrite(server_number, parity_level, version)
+                # other clients may have cached the old parity
+                self.NoteWrite()
+            self.Release()
+            level = levels[-1] + 1
+            self.Throttle(start, level * fsconfig.NUM_SERVERS * fsconfig.BLOCK_SIZE, fsconfig.SCRUB_RATE)
+        elapsed = max(time.time() - start, 1e-9)
+        print('Scrub: checked ' + str(num_levels) + ' stripe levels in ' + '%.3f' % elapsed + ' s, '
+              + '%.2f' % (num_levels * fsconfig.NUM_SERVERS * fsconfig.BLOCK_SIZE / elapsed / 1e6) + ' MB/s, '
+              + str(len(mismatched)) + (' parity mismatches fixed' if fix else ' parity mismatches') + ', '
+              + str(healed) + ' corrupted blocks rebuilt')
+        if len(mismatched) > 0:
+            print('Scrub: mismatched stripe levels: ' + str(mismatched))
+        return mismatched
+
+    ## snapshot: saves the raw blocks of every server to a file on the server's host, path.<server_number>, with
+    ## one Snapshot RPC per server, all in parallel. The lock is held in shared mode, so no client writes while
+    ## the servers save and the files of all servers are of one consistent point. Returns 0, or -1 if a server
+    ## could not be saved
+
+    def snapshot(self, path):
+        self.Acquire(shared = True)
+        try:
+            results = self.ServerCalls([(i, 'Snapshot', (path + '.' + str(i),)) for i in range(0, fsconfig.NUM_SERVERS)])
+        except xmlrpc.client.Fault as err:
+            print('Snapshot: failed: ' + err.faultString)
+            return -1
+        finally:
+            self.Release()
+        if None in results:
+            print('Snapshot: servers ' + str([i for i in range(0, fsconfig.NUM_SERVERS) if results[i] is None]) + ' could not be saved')
+            return -1
+        print('Snapshot: saved ' + str(fsconfig.NUM_SERVERS) + ' servers to ' + path + '.<server>')
+        return 0
+
+    ## restore: loads every server from its snapshot file, holding the lock exclusively. Other clients drop
+    ## the restored blocks from their caches, as the servers give them new versions and this client becomes
+    ## the last writer; this client's cache is cleared. Returns 0, or -1 if a server could not be restored,
+    ## which leaves the servers inconsistent until restore succeeds
 
-            self.server_list[server_number].Put(levels,data)
+    def restore(self, path):
+        self.Acquire()
+        try:
+            results = self.ServerCalls([(i, 'Restore', (path + '.' + str(i),)) for i in range(0, fsconfig.NUM_SERVERS)])
+        except xmlrpc.client.Fault as err:
+            print('Restore: failed: ' + err.faultString)
+            results = [None]
+        self.bcache.Clear()
+        self.FlagLastWriter()
+        self.Release()
+        if None in results:
+            print('Restore: not all servers could be restored')
+            return -1
+        print('Restore: restored ' + str(fsconfig.NUM_SERVERS) + ' servers from ' + path + '.<server>')
+        return 0
+
+    ## Number of stripe levels; the last one is partial if TOTAL_NUM_BLOCKS is not a multiple of the stripe width
+
+    def NumLevels(self):
+        return self.layout.num_levels
+
+    ## Repair progress file: "server_number num_levels epoch next_level"; a file for another array, or for
+    ## the server before it restarted (another epoch), is ignored
+
+    def ReadRepairProgress(self, progress_file, server_number, num_levels, epoch):
+        try:
+            with open(progress_file) as file:
+                saved = [int(x) for x in file.read().split()]
+        except (OSError, ValueError):
+            return 0
+        if len(saved) != 4 or saved[0:3] != [server_number, num_levels, epoch]:
+            return 0
+        return saved[3]
+
+    def WriteRepairProgress(self, progress_file, server_number, num_levels, epoch, next_level):
+        with open(progress_file, 'w') as file:
+            file.write(str(server_number) + ' ' + str(num_levels) + ' ' + str(epoch) + ' ' + str(next_level) + '\n')
 
-        return
 ## RSM: read and set memory equivalent
 
     def RSM(self, block_number):
         logging.debug('RSM: ' + str(block_number))
         
         if block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-            rsm_block_number = block_number//(fsconfig.NUM_SERVERS-1)                             #data_block level
-            rsm_server_number = block_number%(fsconfig.NUM_SERVERS-1)                                   #level for data_block
-            if rsm_server_number >=( rsm_block_number%(fsconfig.NUM_SERVERS)):
-                rsm_server_number+=1
-            rpcretry = True
-            while rpcretry:
-                rpcretry = False
-                try:
-                    data = self.server_list[rsm_server_number].RSM(rsm_block_number)
-                except (socket.timeout, ConnectionRefusedError, xmlrpc.client.ProtocolError) as err:
-                    
-                    if err == socket.timeout:
-                        print("SERVER_TIMED_OUT")
-                        time.sleep(fsconfig.RETRY_INTERVAL)
-                        rpcretry = True
-                    else:
-                        print("DISCONNECTED RSM SERVER NUMBER: ", str(rsm_server_number))
-                    
+            rsm_server_number, rsm_block_number = self.layout.Locate(block_number)
+            data = self.ServerCall(rsm_server_number, 'RSM', rsm_block_number)
             return bytearray(data)
 
-        logging.error('RSM: Block number larger than TOTAL_NUM_BLOCKS: ' + str(rsm_block_number))
+        logging.error('RSM: Block number larger than TOTAL_NUM_BLOCKS: ' + str(block_number))
         quit()
 
 
 
         ## Acquire and Release using a disk block lock
 
-    def Acquire(self):
+    ## The lock is kept by the lock service of the server that stores the RSM lock block. Waiting for it
+    ## costs one blocking LockAcquire call every LOCK_WAIT seconds, and clients get it in FIFO order.
+    ## Acquire(shared=True) takes it in shared mode, for commands that only read: any number of clients
+    ## can hold it in shared mode at the same time, but none while a client holds it exclusively.
+    ## With servers that do not have the lock service, Acquire polls RSM on the lock block with
+    ## exponential backoff instead; that lock is always exclusive
+
+    def LockServer(self):
+        return self.lock_location[0]
+
+    def Acquire(self, shared = False):
         logging.debug('Acquire')
+        if self.lock_service:
+            try:
+                self.AcquireLockService(shared)
+            except xmlrpc.client.Fault:
+                logging.warning('Acquire: server has no lock service, using RSM')
+                self.lock_service = False
+        if not self.lock_service:
+            self.AcquireRSM()
+        # once the lock is acquired, check if need to invalidate cache
+        self.CheckAndInvalidateCache()
+        self.lock_held = not (shared and self.lock_service)
+        return 0
+
+    def AcquireLockService(self, shared):
+        start = time.time()
+        token = self.ServerCall(self.LockServer(), 'LockAcquire', fsconfig.CID, fsconfig.LOCK_LEASE, fsconfig.LOCK_WAIT, shared)
+        while not token:
+            if token is None:
+                # lock server disconnected
+                time.sleep(fsconfig.RETRY_INTERVAL)
+            logging.debug("Acquire: waiting...")
+            start = time.time()
+            token = self.ServerCall(self.LockServer(), 'LockAcquire', fsconfig.CID, fsconfig.LOCK_LEASE, fsconfig.LOCK_WAIT, shared)
+        # fencing token of this grant, needed to renew and release it; the lease runs from the grant, which the
+        # server made after start
+        self.lock_token = token
+        self.lease_start = start
+
+    ## CheckLease: called before writing while holding the lock. Once half of the lease has passed, it is renewed
+    ## (LockRenew), so a holder keeps the lock through a long critical section. If the lease expired, the server
+    ## may have granted the lock to another client, and writing would mix the blocks and parity of two writers:
+    ## this client stops instead of writing
+
+    def CheckLease(self):
+        if not (self.lock_service and self.lock_held):
+            return
+        if time.time() - self.lease_start < fsconfig.LOCK_LEASE / 2:
+            return
+        start = time.time()
+        if not self.ServerCall(self.LockServer(), 'LockRenew', fsconfig.CID, self.lock_token, fsconfig.LOCK_LEASE):
+            logging.error('CheckLease: lease of the lock expired, another client may hold it; not writing')
+            print('LOCK_LEASE_EXPIRED')
+            quit()
+        self.lease_start = start
+
+    def AcquireRSM(self):
         RSM_BLOCK = fsconfig.TOTAL_NUM_BLOCKS - 1
+        backoff = fsconfig.RSM_BACKOFF_MIN
         lockvalue = self.RSM(RSM_BLOCK)
         logging.debug("RSM_BLOCK Lock value: " + str(lockvalue))
         while lockvalue[0] == 1:  # test just first byte of block to check if RSM_LOCKED
             logging.debug("Acquire: spinning...")
+            time.sleep(random.uniform(backoff / 2, backoff))
+            backoff = min(backoff * 2, fsconfig.RSM_BACKOFF_MAX)
             lockvalue = self.RSM(RSM_BLOCK)
-        # once the lock is acquired, check if need to invalidate cache
-        self.CheckAndInvalidateCache()
-        return 0
 
     def Release(self):
         logging.debug('Release')
         RSM_BLOCK = fsconfig.TOTAL_NUM_BLOCKS - 1
+        # dirty blocks must reach the servers before another client can take the lock
+        self.Flush()
+        # flag the last writer once for the whole critical section; not needed if it already is this client
+        if self.wrote_blocks and self.last_writer != fsconfig.CID:
+            self.FlagLastWriter()
+        self.wrote_blocks = False
+        self.lock_held = False
+        if self.lock_service:
+            if not self.ServerCall(self.LockServer(), 'LockRelease', fsconfig.CID, self.lock_token):
+                logging.error('Release: lock was not held any more, its lease expired')
+            return 0
         # Put()s a zero-filled block to release lock
         self.Put(RSM_BLOCK,bytearray(fsconfig.RSM_UNLOCKED.ljust(fsconfig.BLOCK_SIZE, b'\x00')))
         return 0
 
     def CheckAndInvalidateCache(self):
         LAST_WRITER_BLOCK = fsconfig.TOTAL_NUM_BLOCKS - 2
+        # always read the last writer from the server, other clients may have changed it
+        server_number, level = self.layout.Locate(LAST_WRITER_BLOCK)
+        self.bcache.Invalidate(server_number, level)
         last_writer = self.Get(LAST_WRITER_BLOCK)
-        # if ID of last writer is not self, invalidate and update
+        self.last_writer = last_writer[0]
+        # if ID of last writer is not self, invalidate; this client becomes the last writer in Release,
+        # if it writes
         if last_writer[0] != fsconfig.CID:
             if fsconfig.LOGCACHE == 1: print("CACHE_INVALIDATED")
-            self.bcache = []
-            for i in range(fsconfig.NUM_SERVERS):
-                self.bcache.append({})
-            updated_block = bytearray(fsconfig.BLOCK_SIZE)
-            updated_block[0] = fsconfig.CID
-            self.Put(LAST_WRITER_BLOCK,updated_block)
+            self.InvalidateChanged()
 
-    ## Serializes and saves the DiskBlocks block[] data structure to a "dump" file on your disk
+    ## InvalidateChanged: drops from the cache only the blocks other clients wrote since the last check
+    ## Every server numbers its writes and can list the blocks written after a version (Changes); a changed
+    ## block whose version is the one this client's own write got is still valid. The servers are asked
+    ## in parallel. All blocks of a disconnected server are dropped, as others may have written them
+    ## through parity; all blocks of a restarted server (whose epoch changed, see blockserver.DiskBlocks)
+    ## are dropped too, as its versions started over.
+
+    def InvalidateChanged(self):
+        results = self.ServerCalls([(i, 'Changes', (self.seen_versions[i],)) for i in range(0, fsconfig.NUM_SERVERS)])
+        for server_number, changes in enumerate(results):
+            if changes is None:
+                self.bcache.InvalidateServer(server_number)
+                continue
+            version, changed, epoch = changes
+            if epoch != self.server_epochs[server_number]:
+                self.bcache.InvalidateServer(server_number)
+                self.server_epochs[server_number] = epoch
+            for level, block_version in changed:
+                if self.written_versions[server_number].get(level) != block_version:
+                    self.bcache.Invalidate(server_number, level)
+            self.seen_versions[server_number] = version
+            self.written_versions[server_number] = {}
+
+    ## DumpToDisk: saves all blocks to a dump file (see blockdump.py), read from the servers in batches of
+    ## REPAIR_BATCH stripe levels and written as they arrive, holding the lock in shared mode
 
     def DumpToDisk(self, filename):
 
-        logging.info("DiskBlocks::DumpToDisk: Dumping pickled blocks to file " + filename)
-        file = open(filename,'wb')
-        file_system_constants = "BS_" + str(fsconfig.BLOCK_SIZE) + "_NB_" + str(fsconfig.TOTAL_NUM_BLOCKS) + "_IS_" + str(fsconfig.INODE_SIZE) \
-                            + "_MI_" + str(fsconfig.MAX_NUM_INODES) + "_MF_" + str(fsconfig.MAX_FILENAME) + "_IDS_" + str(fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
-        pickle.dump(file_system_constants, file)
-        #pickle.dump(self.block, file)
+        logging.info("DiskBlocks::DumpToDisk: Dumping blocks to file " + filename)
+        batch = fsconfig.REPAIR_BATCH * fsconfig.NUM_SERVERS
+        self.Acquire(shared = True)
+        try:
+            with open(filename, 'wb') as file:
+                writer = blockdump.DumpWriter(file, self.Geometry())
+                for block_number in range(0, fsconfig.TOTAL_NUM_BLOCKS, batch):
+                    for block in self.GetBlocks(list(range(block_number, min(block_number + batch, fsconfig.TOTAL_NUM_BLOCKS)))):
+                        writer.Write(block)
+                writer.Close()
+        finally:
+            self.Release()
+        return 0
+
+    ## The geometry (block size, number of blocks, inode size, number of inodes, file name size, inode number size)
+    ## of this file system, which a dump must have to be loaded
 
-        file.close()
+    def Geometry(self):
+        return (fsconfig.BLOCK_SIZE, fsconfig.TOTAL_NUM_BLOCKS, fsconfig.INODE_SIZE, fsconfig.MAX_NUM_INODES,
+                fsconfig.MAX_FILENAME, fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
 
-    ## Loads DiskBlocks block[] data structure from a "dump" file on your disk
+    ## LoadFromDump: writes the blocks of a dump file (see blockdump.py; older, pickled dumps are read too) to the
+    ## servers while reading it, holding the lock; the lock and LAST_WRITER blocks are left as they are. Blocks go
+    ## out in batches of about REPAIR_BATCH stripe levels, each ending at the end of a level, so every level is
+    ## written whole and its redundancy is computed without reading the servers
 
     def LoadFromDump(self, filename):
 
-        logging.info("DiskBlocks::LoadFromDump: Reading blocks from pickled file " + filename)
+        logging.info("DiskBlocks::LoadFromDump: Reading blocks from file " + filename)
+        batch_size = fsconfig.REPAIR_BATCH * fsconfig.NUM_SERVERS
         file = open(filename,'rb')
-        file_system_constants = "BS_" + str(fsconfig.BLOCK_SIZE) + "_NB_" + str(fsconfig.TOTAL_NUM_BLOCKS) + "_IS_" + str(fsconfig.INODE_SIZE) \
-                            + "_MI_" + str(fsconfig.MAX_NUM_INODES) + "_MF_" + str(fsconfig.MAX_FILENAME) + "_IDS_" + str(fsconfig.INODE_NUMBER_DIRENTRY_SIZE)
-
         try:
-            read_file_system_constants = pickle.load(file)
-            if file_system_constants != read_file_system_constants:
-                print('DiskBlocks::LoadFromDump Error: File System constants of File :' + read_file_system_constants + ' do not match with current file system constants :' + file_system_constants)
+            reader = blockdump.OpenDump(file)
+            if reader.geometry != self.Geometry():
+                print('DiskBlocks::LoadFromDump Error: File System constants of File :' + blockdump.GeometryString(reader.geometry)
+                      + ' do not match with current file system constants :' + blockdump.GeometryString(self.Geometry()))
                 return -1
-            block = pickle.load(file)
-            for i in range(0, fsconfig.TOTAL_NUM_BLOCKS):
-                self.Put(i,block[i])
+            self.Acquire()
+            try:
+                blocks = []
+                # blocks of each level in the batch, to find where a batch can end
+                level_blocks = {}
+                for block_number, block in enumerate(reader.Blocks()):
+                    # the dump's lock and LAST_WRITER blocks are not loaded: they would release the RSM lock, and
+                    # keep this client from being flagged as the last writer in Release
+                    if block_number < fsconfig.TOTAL_NUM_BLOCKS-2:
+                        blocks.append((block_number, block))
+                    level = self.layout.Locate(block_number)[1]
+                    level_blocks[level] = level_blocks.get(level, 0) + 1
+                    if len(blocks) >= batch_size and all(level_blocks[level] == self.layout.row_sizes[level] for level in level_blocks):
+                        self.WriteBlocks(blocks)
+                        blocks = []
+                        level_blocks = {}
+                if len(blocks) > 0:
+                    self.WriteBlocks(blocks)
+            finally:
+                self.Release()
             return 0
-        except TypeError:
-            print("DiskBlocks::LoadFromDump: Error: File not in proper format, encountered type error ")
-            return -1
-        except EOFError:
-            print("DiskBlocks::LoadFromDump: Error: File not in proper format, encountered EOFError error ")
+        except ValueError as err:
+            print("DiskBlocks::LoadFromDump: Error: File not in proper format: " + str(err))
             return -1
         finally:
             file.close()
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+#### CLIENT BLOCK CACHE
+
+# Caches raw blocks of the block servers, keyed by (server_number, level), for block.DiskBlocks.
+# Holds at most capacity blocks (0 means no limit): inserting into a full cache evicts the least
+# recently used block, so memory stays bounded while the blocks in use stay cached.
+# Only clean blocks (the servers' contents) are kept here; the write-back cache's dirty blocks are
+# kept apart by DiskBlocks, so eviction never loses a write.
+
+class BlockCache():
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    ## Lookup: returns the cached block, or None on a miss; a hit makes the block most recently used
+
+    def Lookup(self, server_number, level):
+        key = (server_number, level)
+        data = self.blocks.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.blocks.move_to_end(key)
+        return data
+
+    ## Contains: True if the block is cached; unlike Lookup, not counted as a hit or miss
+
+    def Contains(self, server_number, level):
+        return (server_number, level) in self.blocks
+
+    ## Insert: adds or replaces a block, evicting least recently used blocks beyond capacity
+
+    def Insert(self, server_number, level, data):
+        key = (server_number, level)
+        self.blocks[key] = data
+        self.blocks.move_to_end(key)
+        if self.capacity > 0:
+            while len(self.blocks) > self.capacity:
+                self.blocks.popitem(last=False)
+                self.evictions += 1
+
+    ## Invalidate: drops one block, if cached
+
+    def Invalidate(self, server_number, level):
+        self.blocks.pop((server_number, level), None)
+
+    ## InvalidateServer: drops all blocks of one server
+
+    def InvalidateServer(self, server_number):
+        for key in [key for key in self.blocks if key[0] == server_number]:
+            del self.blocks[key]
+
+    ## Clear: drops all blocks
+
+    def Clear(self):
+        self.blocks.clear()
+
+    ## Returns cache statistics: hits, misses, evictions, and blocks currently cached
+
+    def Stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'blocks': len(self.blocks), 'capacity': self.capacity}
@@ -0,0 +1,168 @@
+import argparse
+import pickle
+import struct
+
+#### DUMP FILES
+
+# A dump holds the raw blocks of a file system, for block.DiskBlocks.DumpToDisk and LoadFromDump.
+# Dumps are written and read as a stream, one block at a time, so memory does not grow with the number of blocks.
+#
+# Format (integers are big-endian):
+#     header: MAGIC (6 bytes), FORMAT_VERSION (2 bytes), then the geometry, 6 x 4 bytes:
+#             block size, number of blocks, inode size, max number of inodes, max file name, inode number size
+#     records, in block order, each starting with a 1-byte tag:
+#         RECORD_BLOCK   tag, block data (block size Bytes)
+#         RECORD_ZEROES  tag, count (4 bytes): count consecutive blocks of zeroes
+#         RECORD_END     tag, number of blocks in the dump (4 bytes)
+#
+# Dumps of the older format are two pickles: the geometry as a string, e.g. 'BS_256_NB_256_IS_32_MI_32_MF_12_IDS_4',
+# and the list of all blocks. LoadFromDump still reads them (whole, as pickle must); ConvertPickleDump, or running
+# this module, converts them to the current format.
+
+MAGIC = b'FSDUMP'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('>6sH6I')
+TAG = struct.Struct('>B')
+COUNT = struct.Struct('>BI')
+
+RECORD_END = 0
+RECORD_BLOCK = 1
+RECORD_ZEROES = 2
+
+# geometry fields, in header order, with their names in the geometry string
+GEOMETRY_FIELDS = ('BS', 'NB', 'IS', 'MI', 'MF', 'IDS')
+
+
+## Geometry string of a geometry tuple, as used by the older format and in messages
+
+def GeometryString(geometry):
+    return '_'.join(name + '_' + str(value) for name, value in zip(GEOMETRY_FIELDS, geometry))
+
+
+def ParseGeometryString(string):
+    parts = string.split('_')
+    if len(parts) != 2 * len(GEOMETRY_FIELDS) or tuple(parts[0::2]) != GEOMETRY_FIELDS:
+        raise ValueError('not a file system geometry: ' + string)
+    return tuple(int(value) for value in parts[1::2])
+
+
+## Writes a dump to a file opened for binary writing; consecutive zero blocks become one record
+
+class DumpWriter():
+    def __init__(self, file, geometry):
+        self.file = file
+        self.block_size = geometry[0]
+        self.zero = bytes(self.block_size)
+        self.zero_run = 0
+        self.count = 0
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION, *geometry))
+
+    def Write(self, block):
+        block = bytes(block).ljust(self.block_size, b'\x00')
+        self.count += 1
+        if block == self.zero:
+            self.zero_run += 1
+            return
+        self.WriteZeroRun()
+        self.file.write(TAG.pack(RECORD_BLOCK) + block)
+
+    def WriteZeroRun(self):
+        if self.zero_run > 0:
+            self.file.write(COUNT.pack(RECORD_ZEROES, self.zero_run))
+            self.zero_run = 0
+
+    ## Ends the dump; the file stays open
+
+    def Close(self):
+        self.WriteZeroRun()
+        self.file.write(COUNT.pack(RECORD_END, self.count))
+
+
+## Reads a dump from a file opened for binary reading; raises ValueError if it is not a complete dump
+
+class DumpReader():
+    def __init__(self, file):
+        self.file = file
+        header = file.read(HEADER.size)
+        if len(header) != HEADER.size or header[0:len(MAGIC)] != MAGIC:
+            raise ValueError('not a dump file')
+        magic, version, *geometry = HEADER.unpack(header)
+        if version != FORMAT_VERSION:
+            raise ValueError('dump format version ' + str(version) + ' is not supported')
+        self.geometry = tuple(geometry)
+        self.block_size = self.geometry[0]
+
+    def Read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise ValueError('dump file is truncated')
+        return data
+
+    ## Yields the blocks in order; blocks of zeroes are one shared bytes object
+
+    def Blocks(self):
+        zero = bytes(self.block_size)
+        count = 0
+        while True:
+            tag = TAG.unpack(self.Read(TAG.size))[0]
+            if tag == RECORD_BLOCK:
+                count += 1
+                yield self.Read(self.block_size)
+            elif tag == RECORD_ZEROES:
+                run = COUNT.unpack(TAG.pack(tag) + self.Read(COUNT.size - TAG.size))[1]
+                for i in range(0, run):
+                    count += 1
+                    yield zero
+            elif tag == RECORD_END:
+                total = COUNT.unpack(TAG.pack(tag) + self.Read(COUNT.size - TAG.size))[1]
+                if total != count:
+                    raise ValueError('dump file has ' + str(count) + ' blocks, its end record says ' + str(total))
+                return
+            else:
+                raise ValueError('unknown dump record ' + str(tag))
+
+
+## Reads a dump of the older, pickled format with the same interface as DumpReader
+
+class PickleDumpReader():
+    def __init__(self, file):
+        try:
+            self.geometry = ParseGeometryString(pickle.load(file))
+            self.blocks = pickle.load(file)
+        except (pickle.UnpicklingError, EOFError, TypeError, AttributeError) as err:
+            raise ValueError('not a dump file: ' + repr(err))
+        self.block_size = self.geometry[0]
+
+    def Blocks(self):
+        for block in self.blocks:
+            yield bytes(block).ljust(self.block_size, b'\x00')
+
+
+## Returns the reader of a dump file of either format
+
+def OpenDump(file):
+    if file.peek(len(MAGIC))[0:len(MAGIC)] == MAGIC:
+        return DumpReader(file)
+    return PickleDumpReader(file)
+
+
+## Converts a dump of the older, pickled format to the current format; returns the number of blocks
+
+def ConvertPickleDump(source, destination):
+    with open(source, 'rb') as file:
+        reader = PickleDumpReader(file)
+    with open(destination, 'wb') as file:
+        writer = DumpWriter(file, reader.geometry)
+        for block in reader.Blocks():
+            writer.Write(block)
+        writer.Close()
+    return writer.count
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='Convert a pickled .dump file to the streaming dump format')
+    ap.add_argument('source', help='dump file of the older, pickled format')
+    ap.add_argument('destination', help='dump file to write')
+    args = ap.parse_args()
+    print('Converted ' + str(ConvertPickleDump(args.source, args.destination)) + ' blocks to ' + args.destination)
@@ -0,0 +1,246 @@
+import logging
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import Future, ThreadPoolExecutor
+
+#### CLIENT I/O
+
+# Persistent connections to the block servers.
+# The default XMLRPC transport opens a new TCP connection for each call whenever the server answers
+# HTTP/1.0-style. This transport talks HTTP/1.1 keep-alive to the block server's matching handler and
+# keeps one connection open, reconnecting only when the server closes it (or was restarted).
+# It also counts how often the open connection is reused and how often it had to connect.
+
+class KeepAliveTransport(xmlrpc.client.Transport):
+    def __init__(self):
+        xmlrpc.client.Transport.__init__(self, use_builtin_types=True)
+        self.requests = 0
+        self.reuses = 0
+        self.connects = 0
+
+    def send_request(self, host, handler, request_body, debug):
+        # make_connection returns the cached connection to host; its socket is None if it has to connect
+        connection = self.make_connection(host)
+        self.requests += 1
+        if connection.sock is None:
+            self.connects += 1
+        else:
+            self.reuses += 1
+        return xmlrpc.client.Transport.send_request(self, host, handler, request_body, debug)
+
+    ## Returns connection statistics: requests sent, connections reused, and (re)connects
+
+    def Stats(self):
+        return {'requests': self.requests, 'reuses': self.reuses, 'connects': self.connects,
+                'reconnects': max(0, self.connects - 1)}
+
+
+# Runs calls to different block servers at the same time.
+# Each server has its own single worker thread, and all calls to that server run in that thread:
+# calls to one server stay in order and its XMLRPC connection is only ever used by one thread,
+# while calls to different servers overlap, so a fan-out costs the slowest server's latency
+# instead of the sum of all of them.
+
+class ParallelIO():
+    def __init__(self, num_servers):
+        self.executors = []
+        for i in range(0, num_servers):
+            self.executors.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix='server' + str(i)))
+
+    ## Submit: queues function(*args) on the worker thread of server_number; returns a Future
+
+    def Submit(self, server_number, function, *args):
+        return self.executors[server_number].submit(function, *args)
+
+    ## Run: runs a list of (server_number, function, args) calls concurrently and waits for all of them
+    ## Returns the results in the order of calls
+
+    def Run(self, calls):
+        logging.debug('ParallelIO::Run: ' + str(len(calls)) + ' calls')
+        futures = []
+        for server_number, function, args in calls:
+            futures.append(self.Submit(server_number, function, *args))
+        return [future.result() for future in futures]
+
+    ## Stops the worker threads once queued calls are done
+
+    def Shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+
+# Runs calls in the calling thread, one after the other, with the interface of ParallelIO. Used with the local
+# backend (see blocklocal.py), whose calls return at once: there is no latency to overlap, and a profile of
+# the file system shows the block operations under the commands that made them
+
+class InlineIO():
+    def Submit(self, server_number, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    def Run(self, calls):
+        logging.debug('InlineIO::Run: ' + str(len(calls)) + ' calls')
+        # every call runs before any error is raised, as with ParallelIO
+        futures = []
+        for server_number, function, args in calls:
+            futures.append(self.Submit(server_number, function, *args))
+        return [future.result() for future in futures]
+
+    def Shutdown(self):
+        return
+
+
+# Health of each block server, as seen by this client: UP, SUSPECT (a call timed out, the server may be
+# slow or failing), DOWN (a call could not connect) or STALE (it answers again after being down). Calls to a
+# DOWN server are not sent at all, so while the array runs degraded the failed server costs nothing per
+# request; its blocks are rebuilt from the other servers instead. A background thread probes the SUSPECT and
+# DOWN servers every interval seconds: a SUSPECT server that answers is UP again, but a DOWN one is STALE,
+# as writes while it was down only reached the redundancy (and a restarted in-memory server is empty).
+# Its blocks are still rebuilt from the other servers, while writes go to it again, until repair (see
+# block.DiskBlocks.repair) has rebuilt it and marks it UP. Without redundancy (rebuildable False) there is
+# nothing to rebuild a server from, and one that answers again is UP.
+
+UP = 'up'
+SUSPECT = 'suspect'
+DOWN = 'down'
+STALE = 'stale'
+
+class ServerHealth():
+    def __init__(self, num_servers, rebuildable = True):
+        self.states = [UP] * num_servers
+        self.rebuildable = rebuildable
+        self.lock = threading.Lock()
+        self.prober = None
+
+    def State(self, server_number):
+        return self.states[server_number]
+
+    def IsDown(self, server_number):
+        return self.states[server_number] == DOWN
+
+    ## True if the blocks of a server can be read from it: it is neither DOWN nor STALE
+
+    def IsReadable(self, server_number):
+        return self.states[server_number] not in (DOWN, STALE)
+
+    ## Sets the state of a server; returns True if it changed
+
+    def Mark(self, server_number, state):
+        with self.lock:
+            changed = self.states[server_number] != state
+            self.states[server_number] = state
+        if changed:
+            logging.info('ServerHealth: server ' + str(server_number) + ' is ' + state)
+        return changed
+
+    ## Starts the background thread that calls probe(server_number) for every SUSPECT or DOWN server;
+    ## probe returns UP if the server answers, else its new state
+
+    def StartProbes(self, probe, interval):
+        self.prober = threading.Thread(target=self.ProbeLoop, args=(probe, interval), daemon=True)
+        self.prober.start()
+
+    def ProbeLoop(self, probe, interval):
+        while True:
+            time.sleep(interval)
+            for server_number in range(0, len(self.states)):
+                state = self.states[server_number]
+                if state not in (SUSPECT, DOWN):
+                    continue
+                new_state = probe(server_number)
+                if new_state == UP and state == DOWN and self.rebuildable:
+                    new_state = STALE
+                self.Mark(server_number, new_state)
+
+
+# Per-server counters kept by the client: requests sent, requests queued or running (the queue depth of
+# the server's worker thread), and a moving average of the response time. DiskBlocks uses them to pick
+# which server to read from when reads are balanced (fsconfig.READ_BALANCE), and shows them with
+# the shell's showservers command. A server is scored by the expected wait of a new request, its average
+# response time times the requests ahead of it.
+
+class ServerLoad():
+    # a server that is offloaded is still read directly once in this many reads, to keep its response time current
+    refresh = 8
+
+    def __init__(self, num_servers, weight, factor):
+        # weight of the newest response time in the moving average
+        self.weight = weight
+        # a server is hot if its score is more than factor times the average score of the other servers
+        self.factor = factor
+        self.requests = [0] * num_servers
+        self.queued = [0] * num_servers
+        self.latency = [None] * num_servers
+        # reads of each server found hot, and those of them served by the other servers
+        self.hot_reads = [0] * num_servers
+        self.offloaded = [0] * num_servers
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    ## Called when a request to a server is submitted, and when it completes
+
+    def Submit(self, server_number):
+        with self.lock:
+            self.requests[server_number] += 1
+            self.queued[server_number] += 1
+
+    def Complete(self, server_number):
+        with self.lock:
+            self.queued[server_number] -= 1
+
+    ## Records the response time of a server (in seconds)
+
+    def Record(self, server_number, seconds):
+        with self.lock:
+            if self.latency[server_number] is None:
+                self.latency[server_number] = seconds
+            else:
+                self.latency[server_number] += self.weight * (seconds - self.latency[server_number])
+
+    ## Expected wait of a new request to a server; 0 if it did not answer a request yet
+
+    def Score(self, server_number):
+        return (self.latency[server_number] or 0) * (1 + self.queued[server_number])
+
+    ## Returns one of server_numbers to read from: the servers whose score is within factor of the lowest
+    ## take turns, so equally loaded servers share the reads
+
+    def Pick(self, server_numbers):
+        least = min(self.Score(i) for i in server_numbers)
+        candidates = [i for i in server_numbers if self.Score(i) <= self.factor * least]
+        with self.lock:
+            self.turn += 1
+            return candidates[self.turn % len(candidates)]
+
+    def IsHot(self, server_number):
+        others = [self.Score(i) for i in range(0, len(self.requests)) if i != server_number]
+        return len(others) > 0 and self.Score(server_number) > self.factor * sum(others) / len(others)
+
+    ## Returns True if a read of server_number should be served by the other servers instead, i.e. the
+    ## server is hot, except for one read in refresh
+
+    def Offload(self, server_number):
+        if not self.IsHot(server_number):
+            return False
+        with self.lock:
+            self.hot_reads[server_number] += 1
+            if self.hot_reads[server_number] % self.refresh == 0:
+                return False
+            self.offloaded[server_number] += 1
+            return True
+
+    ## Returns requests, queued requests, response time (ms) and offloaded reads of each server
+
+    def Stats(self):
+        stats = []
+        for i in range(0, len(self.requests)):
+            latency = self.latency[i]
+            stats.append({'requests': self.requests[i], 'queued': self.queued[i],
+                          'latency_ms': round(latency * 1000, 3) if latency is not None else None,
+                          'offloaded': self.offloaded[i]})
+        return stats
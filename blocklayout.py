@@ -0,0 +1,301 @@
+import logging
+from functools import lru_cache
+
+from blockxor import XorBlocks
+
+#### RAID LAYOUTS
+
+# A layout maps logical block numbers to (server_number, level) for block.DiskBlocks, and defines the
+# redundancy of the array. Level L of every server belongs to the same stripe row: some servers hold data
+# blocks at L, the others hold redundancy computed from that data (parity, or copies).
+#
+# Blocks are laid out in stripe units of stripe_unit consecutive blocks. A unit fills stripe_unit consecutive
+# levels of one server, so a sequential read of a file goes to one server in one GetMany. Units rotate across
+# the data servers of a row; the redundancy servers rotate from one row of units to the next (left-asymmetric).
+# With stripe_unit 1, RAID-5 is the layout the block layer always had.
+#
+# The mapping is computed once into lookup tables, so Locate and Row are list lookups.
+#
+# Blocks are passed as dicts {server_number: block}. A data server that is neither in the dict nor missing
+# counts as zeroes; DiskBlocks uses this to keep the lock block out of the redundancy.
+#
+# A partial-row write does not rewrite the redundancy: Delta returns, for each redundancy server, the block
+# to XOR into its redundancy block, which the server applies in place (see blockserver.DiskBlocks.XorPut).
+
+class Layout():
+    # servers that may be missing at the same level and still be recovered
+    max_failures = 0
+
+    def __init__(self, num_servers, total_num_blocks, block_size, stripe_unit = 1):
+        self.num_servers = num_servers
+        self.total_num_blocks = total_num_blocks
+        self.block_size = block_size
+        self.stripe_unit = stripe_unit
+        # block number -> (server_number, level); level -> number of blocks stored at that level
+        self.locations = []
+        self.row_sizes = []
+        for block_number in range(0, total_num_blocks):
+            location = self.Map(block_number)
+            self.locations.append(location)
+            while len(self.row_sizes) <= location[1]:
+                self.row_sizes.append(0)
+            self.row_sizes[location[1]] += 1
+        self.num_levels = len(self.row_sizes)
+        # level -> (data servers in stripe order, redundancy servers)
+        self.rows = [self.MapRow(level) for level in range(0, self.num_levels)]
+
+    ## Returns (server_number, level) of a logical block
+
+    def Locate(self, block_number):
+        return self.locations[block_number]
+
+    ## Returns (data servers, redundancy servers) of a level
+
+    def Row(self, level):
+        return self.rows[level]
+
+    ## Returns True if blocks, a dict {server_number: block} of data servers, is every block stored at level,
+    ## so its redundancy can be computed without reading the level
+
+    def IsFullRow(self, level, blocks):
+        return len(blocks) == self.row_sizes[level]
+
+    ## Returns the servers holding a copy of the block stored at (server_number, level)
+
+    def Copies(self, server_number, level):
+        return (server_number,)
+
+    def Zeroes(self):
+        return bytearray(self.block_size)
+
+
+## RAID-0: blocks striped across all servers, no redundancy
+
+class Raid0Layout(Layout):
+
+    def Map(self, block_number):
+        unit, offset = divmod(block_number, self.stripe_unit)
+        row, server_number = divmod(unit, self.num_servers)
+        return server_number, row * self.stripe_unit + offset
+
+    def MapRow(self, level):
+        return tuple(range(0, self.num_servers)), ()
+
+    def Encode(self, level, data):
+        return []
+
+    def Delta(self, level, old, new):
+        return []
+
+    def Recover(self, level, blocks, missing):
+        return None
+
+
+## RAID-1: every server holds a copy of every block; reads go to the primary copy, which rotates
+## across the servers by stripe unit, unless reads are balanced across the copies (see block.DiskBlocks.ReadLocation)
+
+class Raid1Layout(Layout):
+
+    @property
+    def max_failures(self):
+        return self.num_servers - 1
+
+    def Map(self, block_number):
+        return (block_number // self.stripe_unit) % self.num_servers, block_number
+
+    def MapRow(self, level):
+        primary = (level // self.stripe_unit) % self.num_servers
+        return (primary,), tuple(i for i in range(0, self.num_servers) if i != primary)
+
+    def Copies(self, server_number, level):
+        return tuple(range(0, self.num_servers))
+
+    def Encode(self, level, data):
+        block = next(iter(data.values()), None)
+        if block is None:
+            block = self.Zeroes()
+        return [bytearray(block) for i in self.Row(level)[1]]
+
+    # a copy changes like the block it copies
+    def Delta(self, level, old, new):
+        return [XorBlocks(self.Zeroes(), *old.values(), *new.values()) for i in self.Row(level)[1]]
+
+    # any copy will do
+    def Recover(self, level, blocks, missing):
+        if len(missing) >= self.num_servers:
+            return None
+        block = next(iter(blocks.values()), None)
+        if block is None:
+            block = self.Zeroes()
+        return [bytearray(block) for i in missing]
+
+
+## RAID-5: one parity block per row, the XOR of its data blocks
+
+class Raid5Layout(Layout):
+    max_failures = 1
+
+    def Map(self, block_number):
+        unit, offset = divmod(block_number, self.stripe_unit)
+        row, server_number = divmod(unit, self.num_servers - 1)
+        parity_server_number = row % self.num_servers
+        if server_number >= parity_server_number:
+            server_number += 1
+        return server_number, row * self.stripe_unit + offset
+
+    def MapRow(self, level):
+        parity_server_number = (level // self.stripe_unit) % self.num_servers
+        return tuple(i for i in range(0, self.num_servers) if i != parity_server_number), (parity_server_number,)
+
+    # new parity from the new data alone
+    def Encode(self, level, data):
+        return [XorBlocks(self.Zeroes(), *data.values())]
+
+    # read-modify-write: new_parity = old_parity ^ (old_data ^ new_data)
+    def Delta(self, level, old, new):
+        return [XorBlocks(self.Zeroes(), *old.values(), *new.values())]
+
+    # a missing block is the XOR of the others
+    def Recover(self, level, blocks, missing):
+        if len(missing) > 1:
+            return None
+        return [XorBlocks(self.Zeroes(), *blocks.values())]
+
+
+## RAID-6: two redundancy blocks per row, P (the XOR of the data blocks, as in RAID-5) and Q, the Reed-Solomon
+## syndrome sum(g^i * D_i) over GF(2^8) with generator g = 2, where D_i is the data block at position i of
+## the row. Any two blocks of a row can be recovered.
+
+GF_POLYNOMIAL = 0x11d
+
+
+## Exponent and logarithm tables of GF(2^8); GF_EXP is doubled so a product needs no modulo
+
+def GfTables():
+    exp = [0] * 512
+    log = [0] * 256
+    value = 1
+    for exponent in range(0, 255):
+        exp[exponent] = value
+        log[value] = exponent
+        value <<= 1
+        if value & 0x100:
+            value ^= GF_POLYNOMIAL
+    for exponent in range(255, 512):
+        exp[exponent] = exp[exponent - 255]
+    return exp, log
+
+GF_EXP, GF_LOG = GfTables()
+
+
+def GfMul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def GfDiv(a, b):
+    if a == 0:
+        return 0
+    return GF_EXP[(GF_LOG[a] - GF_LOG[b]) % 255]
+
+
+## Multiplication table of a constant, for bytes.translate: multiplies a whole block in one C call
+
+@lru_cache(maxsize=256)
+def GfMulTable(factor):
+    return bytes(GfMul(factor, x) for x in range(0, 256))
+
+
+def GfMulBlock(block, factor):
+    return bytearray(block).translate(GfMulTable(factor))
+
+
+class Raid6Layout(Layout):
+    max_failures = 2
+
+    def Map(self, block_number):
+        unit, offset = divmod(block_number, self.stripe_unit)
+        row, position = divmod(unit, self.num_servers - 2)
+        data_servers = self.RowServers(row)[0]
+        return data_servers[position], row * self.stripe_unit + offset
+
+    def MapRow(self, level):
+        return self.RowServers(level // self.stripe_unit)
+
+    def RowServers(self, row):
+        p = row % self.num_servers
+        q = (row + 1) % self.num_servers
+        return tuple(i for i in range(0, self.num_servers) if i != p and i != q), (p, q)
+
+    ## Q of the given data blocks: XOR of g^position * block
+
+    def Syndrome(self, level, data):
+        data_servers = self.Row(level)[0]
+        terms = [GfMulBlock(data[server_number], GF_EXP[data_servers.index(server_number)]) for server_number in data]
+        return XorBlocks(self.Zeroes(), *terms)
+
+    def Encode(self, level, data):
+        return [XorBlocks(self.Zeroes(), *data.values()), self.Syndrome(level, data)]
+
+    # P and Q are linear in the data, so the change of each is P and Q of the change of the data
+    def Delta(self, level, old, new):
+        delta = {}
+        for server_number in new:
+            if server_number in old:
+                delta[server_number] = XorBlocks(old[server_number], new[server_number])
+            else:
+                delta[server_number] = new[server_number]
+        return self.Encode(level, delta)
+
+    def Recover(self, level, blocks, missing):
+        if len(missing) > 2:
+            return None
+        data_servers, (p, q) = self.Row(level)
+        data = {}
+        for server_number in data_servers:
+            if server_number in blocks:
+                data[server_number] = blocks[server_number]
+        lost = [server_number for server_number in missing if server_number in data_servers]
+        if len(lost) == 1 and p not in missing:
+            # like RAID-5: P ^ the other data blocks
+            data[lost[0]] = XorBlocks(blocks[p], *data.values())
+        elif len(lost) == 1:
+            # from Q: g^x * D_x = Q ^ Q(other data blocks)
+            x = data_servers.index(lost[0])
+            data[lost[0]] = GfMulBlock(XorBlocks(blocks[q], self.Syndrome(level, data)), GfDiv(1, GF_EXP[x]))
+        elif len(lost) == 2:
+            # D_x ^ D_y = P ^ P(others) and g^x * D_x ^ g^y * D_y = Q ^ Q(others), solved for D_x and D_y
+            x = data_servers.index(lost[0])
+            y = data_servers.index(lost[1])
+            pxy = XorBlocks(blocks[p], *data.values())
+            qxy = XorBlocks(blocks[q], self.Syndrome(level, data))
+            denominator = GF_EXP[x] ^ GF_EXP[y]
+            data[lost[0]] = GfMulBlock(XorBlocks(qxy, GfMulBlock(pxy, GF_EXP[y])), GfDiv(1, denominator))
+            data[lost[1]] = XorBlocks(pxy, data[lost[0]])
+        recovered = []
+        for server_number in missing:
+            if server_number in data_servers:
+                recovered.append(data[server_number])
+            else:
+                recovered.append(self.Encode(level, data)[0 if server_number == p else 1])
+        return recovered
+
+
+LAYOUTS = {0: Raid0Layout, 1: Raid1Layout, 5: Raid5Layout, 6: Raid6Layout}
+MIN_SERVERS = {0: 1, 1: 1, 5: 2, 6: 3}
+
+
+## Builds the layout of a RAID level (0, 1, 5 or 6)
+
+def NewLayout(raid_level, num_servers, total_num_blocks, block_size, stripe_unit = 1):
+    if raid_level not in LAYOUTS:
+        logging.error('NewLayout: unknown RAID level ' + str(raid_level))
+        quit()
+    if num_servers < MIN_SERVERS[raid_level]:
+        print('RAID-' + str(raid_level) + ' needs at least ' + str(MIN_SERVERS[raid_level]) + ' servers')
+        quit()
+    if stripe_unit < 1:
+        print('Stripe unit must be at least 1 block')
+        quit()
+    return LAYOUTS[raid_level](num_servers, total_num_blocks, block_size, stripe_unit)
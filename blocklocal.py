@@ -0,0 +1,95 @@
+import xmlrpc.client
+
+import blockserver
+import blockstore
+
+#### LOCAL BACKEND
+
+# In-process stand-in for one block server, selected with fsconfig.BACKEND 'local' (fsmain -backend local).
+# It has the methods of the XMLRPC ServerProxy and of blockprotocol.BinaryBlockClient, and runs them directly
+# on a blockserver.DiskBlocks kept in memory (a plain array of blocks, see blockstore.MemoryStore) and on its
+# own blockserver.LockService. DiskBlocks (block.py) keeps one per server, so NUM_SERVERS, RAID_LEVEL and
+# STRIPE_UNIT simulate the array, parity included, with no block server running and no network costs; a
+# single server with RAID-0 is a plain array. The blocks are only seen by this client and lost on exit.
+#
+# Like a real server, it replies with copies (bytes) of the stored blocks and ZERO_BLOCK for zero blocks, and
+# a failed operation (e.g. Restore from a missing file) is raised as xmlrpc.client.Fault.
+
+# requests are never delayed (see blockserver.DiskBlocks.Sleep)
+NO_DELAY = 1000000000
+
+class LocalBlockServer():
+    def __init__(self, total_num_blocks, block_size):
+        store = blockstore.MemoryStore(total_num_blocks, block_size)
+        self.blocks = blockserver.DiskBlocks(total_num_blocks, block_size, NO_DELAY, store)
+        self.locks = blockserver.LockService()
+        self.requests = 0
+
+    ## Runs one operation of the server
+
+    def Call(self, function, *args):
+        self.requests += 1
+        try:
+            return function(*args)
+        except (OSError, ValueError) as err:
+            raise xmlrpc.client.Fault(1, repr(err))
+
+    ## A reply block as a server sends it: a copy, so the caller never shares the stored block
+
+    def Copy(self, block):
+        if isinstance(block, bytearray):
+            return bytes(block)
+        return block
+
+    def Get(self, block_number):
+        return self.Copy(self.Call(self.blocks.Get, block_number))
+
+    def Put(self, block_number, data):
+        return self.Call(self.blocks.Put, block_number, data)
+
+    def RSM(self, block_number):
+        return self.Copy(self.Call(self.blocks.RSM, block_number))
+
+    def GetMany(self, block_numbers):
+        return [self.Copy(block) for block in self.Call(self.blocks.GetMany, block_numbers)]
+
+    def PutMany(self, blocks, deltas = (), request = None):
+        return self.Call(self.blocks.PutMany, blocks, deltas, request)
+
+    def XorPut(self, block_number, delta, new_block = False, request = None):
+        result = self.Call(self.blocks.XorPut, block_number, delta, new_block, request)
+        if new_block:
+            return [result[0], self.Copy(result[1])]
+        return result
+
+    def XorPutMany(self, blocks, new_blocks = False, request = None):
+        result = self.Call(self.blocks.XorPutMany, blocks, new_blocks, request)
+        if new_blocks:
+            return [[version, self.Copy(block)] for version, block in result]
+        return result
+
+    def Snapshot(self, path):
+        return self.Call(self.blocks.Snapshot, path)
+
+    def Restore(self, path):
+        return self.Call(self.blocks.Restore, path)
+
+    def Changes(self, since):
+        return self.Call(self.blocks.Changes, since)
+
+    def Epoch(self):
+        return self.Call(self.blocks.Epoch)
+
+    def LockAcquire(self, client_id, lease, wait, shared = False):
+        return self.Call(self.locks.LockAcquire, client_id, lease, wait, shared)
+
+    def LockRelease(self, client_id, token):
+        return self.Call(self.locks.LockRelease, client_id, token)
+
+    def LockRenew(self, client_id, token, lease):
+        return self.Call(self.locks.LockRenew, client_id, token, lease)
+
+    ## Returns statistics in the form of the connections' (see blockio.KeepAliveTransport): requests, and no connections
+
+    def Stats(self):
+        return {'requests': self.requests, 'reuses': 0, 'connects': 0, 'reconnects': 0}
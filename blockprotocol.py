@@ -0,0 +1,401 @@
+import logging
+import socket
+import struct
+import socketserver
+import xmlrpc.client
+
+#### BINARY BLOCK PROTOCOL
+
+# A compact alternative to XMLRPC between block.DiskBlocks and blockserver.py.
+# XMLRPC sends block payloads as <base64> inside XML, which inflates every block by about 33% and
+# needs XML parsing on both ends. This protocol sends raw bytes in length-prefixed frames over TCP.
+#
+# A client connection starts with the 4-byte MAGIC, so the block server can tell it apart from an
+# HTTP (XMLRPC) connection on the same port. After that, each request is one frame:
+#     opcode (1 byte) | payload length (4 bytes, big-endian) | payload
+# and each reply is one frame:
+#     status (1 byte, 0=OK, 1=error) | payload length (4 bytes) | payload (error message if status=1)
+#
+# Payloads (integers are 4 bytes, versions 8 bytes, big-endian):
+#     GET      request: block_number                             reply: block data
+#     PUT      request: block_number, block data                 reply: version
+#     RSM      request: block_number                             reply: block data (before the set)
+#     GETMANY  request: count, count x block_number              reply: count x (length, block data)
+#     PUTMANY  request: count, count x (block_number, length, block data) [, count, count x (block_number, length, delta)
+#                       [, request id]]
+#              reply: count, count x version
+#     CHANGES  request: version                                  reply: version, count, count x (block_number, version), epoch
+#     EPOCH    request: (empty)                                  reply: epoch
+#     LOCKACQUIRE  request: client_id, lease, wait (8-byte doubles), shared (1 byte)    reply: token (8 bytes)
+#     LOCKRELEASE  request: client_id, token (8 bytes)                 reply: 1 if released, else 0
+#     LOCKRENEW    request: client_id, token (8 bytes), lease (8-byte double)    reply: 1 if renewed, else 0
+#     XORPUT       request: block_number, flags (1 byte) [, request id], delta        reply: version [, block data]
+#     XORPUTMANY   request: flags (1 byte) [, request id], count, count x (block_number, length, delta)
+#                  reply: count, count x version [, count, count x (length, block data)]
+#     SNAPSHOT     request: path (UTF-8)                           reply: version
+#     RESTORE      request: path (UTF-8)                           reply: version
+# flags: FLAG_NEW_BLOCKS to return the new blocks, FLAG_REQUEST if a request id follows. A request id (see
+# blockserver.DiskBlocks.Once) is client_id, session, sequence, 4 bytes each.
+# GET and GETMANY return an empty block in place of a block that failed the server's checksum.
+# A block that is all zeroes is not sent: GET replies with status 2 (STATUS_ZERO) and no payload, and
+# GETMANY with length ZERO_LENGTH and no data. Both decode to ZERO_BLOCK, which XMLRPC sends as is.
+
+MAGIC = b'GBP1'
+
+OP_GET = 1
+OP_PUT = 2
+OP_RSM = 3
+OP_GETMANY = 4
+OP_PUTMANY = 5
+OP_CHANGES = 6
+OP_LOCKACQUIRE = 7
+OP_LOCKRELEASE = 8
+OP_XORPUT = 9
+OP_XORPUTMANY = 10
+OP_SNAPSHOT = 11
+OP_RESTORE = 12
+OP_LOCKRENEW = 13
+OP_EPOCH = 14
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_ZERO = 2
+
+# returned by Get and GetMany (both protocols) in place of a block that is all zeroes
+ZERO_BLOCK = 0
+ZERO_LENGTH = 0xffffffff
+
+HEADER = struct.Struct('>BI')
+NUMBER = struct.Struct('>I')
+PAIR = struct.Struct('>II')
+VERSION = struct.Struct('>Q')
+CHANGE = struct.Struct('>IQ')
+LOCKACQUIRE = struct.Struct('>IddB')
+LOCKRENEW = struct.Struct('>IQd')
+FLAG = struct.Struct('>B')
+XORPUT = struct.Struct('>IB')
+REQUEST = struct.Struct('>III')
+
+FLAG_NEW_BLOCKS = 1
+FLAG_REQUEST = 2
+
+
+## Reads exactly n bytes from a socket; raises ConnectionResetError if the peer closes the connection
+
+def RecvExactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionResetError('connection closed by peer')
+        data += chunk
+    return data
+
+
+## Frame encoding helpers, shared by client and server
+
+def SendFrame(sock, code, payload):
+    sock.sendall(HEADER.pack(code, len(payload)) + payload)
+
+def RecvFrame(sock):
+    code, length = HEADER.unpack(RecvExactly(sock, HEADER.size))
+    return code, RecvExactly(sock, length)
+
+def EncodeBlockList(blocks):
+    parts = [NUMBER.pack(len(blocks))]
+    for data in blocks:
+        if data == ZERO_BLOCK:
+            parts.append(NUMBER.pack(ZERO_LENGTH))
+            continue
+        parts.append(NUMBER.pack(len(data)))
+        parts.append(bytes(data))
+    return b''.join(parts)
+
+def DecodeBlockList(payload):
+    count = NUMBER.unpack_from(payload, 0)[0]
+    offset = NUMBER.size
+    blocks = []
+    for i in range(0, count):
+        length = NUMBER.unpack_from(payload, offset)[0]
+        offset += NUMBER.size
+        if length == ZERO_LENGTH:
+            blocks.append(ZERO_BLOCK)
+            continue
+        blocks.append(bytes(payload[offset:offset+length]))
+        offset += length
+    return blocks
+
+def EncodeNumberedBlocks(blocks):
+    parts = [NUMBER.pack(len(blocks))]
+    for block_number, data in blocks:
+        parts.append(PAIR.pack(block_number, len(data)))
+        parts.append(bytes(data))
+    return b''.join(parts)
+
+def DecodeNumberedBlocks(payload, offset = 0):
+    return DecodeNumberedBlocksAt(payload, offset)[0]
+
+## Returns the blocks and the offset after them, where another list may follow
+
+def DecodeNumberedBlocksAt(payload, offset):
+    count = NUMBER.unpack_from(payload, offset)[0]
+    offset += NUMBER.size
+    blocks = []
+    for i in range(0, count):
+        block_number, length = PAIR.unpack_from(payload, offset)
+        offset += PAIR.size
+        blocks.append((block_number, bytes(payload[offset:offset+length])))
+        offset += length
+    return blocks, offset
+
+def EncodeNumbers(numbers):
+    return NUMBER.pack(len(numbers)) + b''.join(NUMBER.pack(n) for n in numbers)
+
+def DecodeNumbers(payload):
+    count = NUMBER.unpack_from(payload, 0)[0]
+    return [NUMBER.unpack_from(payload, NUMBER.size * (i+1))[0] for i in range(0, count)]
+
+def EncodeVersions(versions):
+    return NUMBER.pack(len(versions)) + b''.join(VERSION.pack(v) for v in versions)
+
+def DecodeVersions(payload):
+    count = NUMBER.unpack_from(payload, 0)[0]
+    return [VERSION.unpack_from(payload, NUMBER.size + VERSION.size * i)[0] for i in range(0, count)]
+
+def EncodeXorPutMany(result, new_blocks):
+    if not new_blocks:
+        return EncodeVersions(result)
+    return EncodeVersions([version for version, data in result]) + EncodeBlockList([data for version, data in result])
+
+def DecodeXorPutMany(payload, new_blocks):
+    versions = DecodeVersions(payload)
+    if not new_blocks:
+        return versions
+    blocks = DecodeBlockList(payload[NUMBER.size + VERSION.size * len(versions):])
+    return [[version, data] for version, data in zip(versions, blocks)]
+
+## Flags byte and request id of XORPUT and XORPUTMANY
+
+def EncodeXorFlags(new_blocks, request):
+    flags = FLAG_NEW_BLOCKS if new_blocks else 0
+    if request is None:
+        return flags, b''
+    return flags | FLAG_REQUEST, REQUEST.pack(*request)
+
+## Returns new_blocks, the request id (None if there is none) and the offset after them
+
+def DecodeXorFlags(flags, payload, offset):
+    if flags & FLAG_REQUEST:
+        return flags & FLAG_NEW_BLOCKS != 0, list(REQUEST.unpack_from(payload, offset)), offset + REQUEST.size
+    return flags & FLAG_NEW_BLOCKS != 0, None, offset
+
+def EncodeChanges(changes):
+    version, changed, epoch = changes
+    parts = [VERSION.pack(version), NUMBER.pack(len(changed))]
+    for block_number, block_version in changed:
+        parts.append(CHANGE.pack(block_number, block_version))
+    parts.append(NUMBER.pack(epoch))
+    return b''.join(parts)
+
+def DecodeChanges(payload):
+    version = VERSION.unpack_from(payload, 0)[0]
+    count = NUMBER.unpack_from(payload, VERSION.size)[0]
+    offset = VERSION.size + NUMBER.size
+    changed = []
+    for i in range(0, count):
+        changed.append(list(CHANGE.unpack_from(payload, offset + CHANGE.size * i)))
+    epoch = NUMBER.unpack_from(payload, offset + CHANGE.size * count)[0]
+    return [version, changed, epoch]
+
+
+#### Client side
+
+# Drop-in replacement for the XMLRPC ServerProxy of one block server: same method names and arguments.
+# Keeps one persistent TCP connection, reconnecting once if a kept connection turns out to be closed.
+# A server-side error is raised as xmlrpc.client.Fault, like the XMLRPC client does.
+
+class BinaryBlockClient():
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = None
+        self.requests = 0
+        self.reuses = 0
+        self.connects = 0
+
+    def Connect(self):
+        self.sock = socket.create_connection(self.address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(MAGIC)
+        self.connects += 1
+
+    def Close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    ## Sends one request frame and returns the reply payload
+
+    def Call(self, opcode, payload):
+        self.requests += 1
+        for attempt in (0, 1):
+            reused = self.sock is not None
+            if not reused:
+                self.Connect()
+            else:
+                self.reuses += 1
+            try:
+                SendFrame(self.sock, opcode, payload)
+                status, reply = RecvFrame(self.sock)
+                break
+            except socket.timeout:
+                self.Close()
+                raise
+            except OSError:
+                self.Close()
+                # a kept connection may have been closed by the server (e.g. restarted): retry once
+                if attempt == 1 or not reused:
+                    raise
+        if status == STATUS_ZERO:
+            return ZERO_BLOCK
+        if status != STATUS_OK:
+            raise xmlrpc.client.Fault(1, reply.decode(errors='replace'))
+        return reply
+
+    def Get(self, block_number):
+        return self.Call(OP_GET, NUMBER.pack(block_number))
+
+    def Put(self, block_number, data):
+        return VERSION.unpack(self.Call(OP_PUT, NUMBER.pack(block_number) + bytes(data)))[0]
+
+    def RSM(self, block_number):
+        return self.Call(OP_RSM, NUMBER.pack(block_number))
+
+    def GetMany(self, block_numbers):
+        return DecodeBlockList(self.Call(OP_GETMANY, EncodeNumbers(block_numbers)))
+
+    def PutMany(self, blocks, deltas = (), request = None):
+        payload = EncodeNumberedBlocks(blocks)
+        if len(deltas) > 0 or request is not None:
+            payload += EncodeNumberedBlocks(deltas)
+        if request is not None:
+            payload += REQUEST.pack(*request)
+        return DecodeVersions(self.Call(OP_PUTMANY, payload))
+
+    def XorPut(self, block_number, delta, new_block = False, request = None):
+        flags, request_id = EncodeXorFlags(new_block, request)
+        reply = self.Call(OP_XORPUT, XORPUT.pack(block_number, flags) + request_id + bytes(delta))
+        version = VERSION.unpack_from(reply, 0)[0]
+        if new_block:
+            return [version, bytes(reply[VERSION.size:])]
+        return version
+
+    def XorPutMany(self, blocks, new_blocks = False, request = None):
+        flags, request_id = EncodeXorFlags(new_blocks, request)
+        reply = self.Call(OP_XORPUTMANY, FLAG.pack(flags) + request_id + EncodeNumberedBlocks(blocks))
+        return DecodeXorPutMany(reply, new_blocks)
+
+    def Snapshot(self, path):
+        return VERSION.unpack(self.Call(OP_SNAPSHOT, path.encode()))[0]
+
+    def Restore(self, path):
+        return VERSION.unpack(self.Call(OP_RESTORE, path.encode()))[0]
+
+    def Changes(self, since):
+        return DecodeChanges(self.Call(OP_CHANGES, VERSION.pack(since)))
+
+    def Epoch(self):
+        return NUMBER.unpack(self.Call(OP_EPOCH, b''))[0]
+
+    def LockAcquire(self, client_id, lease, wait, shared = False):
+        return VERSION.unpack(self.Call(OP_LOCKACQUIRE, LOCKACQUIRE.pack(client_id, lease, wait, 1 if shared else 0)))[0]
+
+    def LockRelease(self, client_id, token):
+        return NUMBER.unpack(self.Call(OP_LOCKRELEASE, CHANGE.pack(client_id, token)))[0] == 1
+
+    def LockRenew(self, client_id, token, lease):
+        return NUMBER.unpack(self.Call(OP_LOCKRENEW, LOCKRENEW.pack(client_id, token, lease)))[0] == 1
+
+    ## Returns connection statistics: requests sent, connections reused, and (re)connects
+
+    def Stats(self):
+        return {'requests': self.requests, 'reuses': self.reuses, 'connects': self.connects,
+                'reconnects': max(0, self.connects - 1)}
+
+
+#### Server side
+
+# Serves binary connections by calling the functions registered on the block server's dispatcher,
+# so both protocols run exactly the same block operations (and the same locking).
+# The server picks this handler when a connection starts with MAGIC (see blockserver.BlockServer).
+
+class BinaryRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        RecvExactly(self.request, len(MAGIC))
+        while True:
+            try:
+                opcode, payload = RecvFrame(self.request)
+            except OSError:
+                return
+            # an error of the operation (e.g. a file that Restore cannot open) is sent back; an error of the
+            # connection ends it
+            try:
+                reply = self.Dispatch(opcode, payload)
+                status = STATUS_OK
+                if reply == ZERO_BLOCK:
+                    status, reply = STATUS_ZERO, b''
+            except Exception as err:
+                logging.error('BinaryRequestHandler: ' + repr(err))
+                status, reply = STATUS_ERROR, repr(err).encode()
+            try:
+                SendFrame(self.request, status, reply)
+            except OSError:
+                return
+
+    def Dispatch(self, opcode, payload):
+        dispatch = self.server._dispatch
+        if opcode == OP_GET:
+            data = dispatch('Get', (NUMBER.unpack_from(payload, 0)[0],))
+            if data == ZERO_BLOCK:
+                return ZERO_BLOCK
+            return bytes(data)
+        if opcode == OP_PUT:
+            return VERSION.pack(dispatch('Put', (NUMBER.unpack_from(payload, 0)[0], bytes(payload[NUMBER.size:]))))
+        if opcode == OP_RSM:
+            return bytes(dispatch('RSM', (NUMBER.unpack_from(payload, 0)[0],)))
+        if opcode == OP_GETMANY:
+            return EncodeBlockList(dispatch('GetMany', (DecodeNumbers(payload),)))
+        if opcode == OP_PUTMANY:
+            blocks, offset = DecodeNumberedBlocksAt(payload, 0)
+            if offset == len(payload):
+                return EncodeVersions(dispatch('PutMany', (blocks,)))
+            deltas, offset = DecodeNumberedBlocksAt(payload, offset)
+            request = list(REQUEST.unpack_from(payload, offset)) if offset < len(payload) else None
+            return EncodeVersions(dispatch('PutMany', (blocks, deltas, request)))
+        if opcode == OP_XORPUT:
+            block_number, flags = XORPUT.unpack_from(payload, 0)
+            new_block, request, offset = DecodeXorFlags(flags, payload, XORPUT.size)
+            result = dispatch('XorPut', (block_number, bytes(payload[offset:]), new_block, request))
+            if new_block:
+                return VERSION.pack(result[0]) + bytes(result[1])
+            return VERSION.pack(result)
+        if opcode == OP_XORPUTMANY:
+            new_blocks, request, offset = DecodeXorFlags(FLAG.unpack_from(payload, 0)[0], payload, FLAG.size)
+            return EncodeXorPutMany(dispatch('XorPutMany', (DecodeNumberedBlocks(payload, offset), new_blocks, request)), new_blocks)
+        if opcode == OP_SNAPSHOT:
+            return VERSION.pack(dispatch('Snapshot', (bytes(payload).decode(),)))
+        if opcode == OP_RESTORE:
+            return VERSION.pack(dispatch('Restore', (bytes(payload).decode(),)))
+        if opcode == OP_CHANGES:
+            return EncodeChanges(dispatch('Changes', (VERSION.unpack_from(payload, 0)[0],)))
+        if opcode == OP_EPOCH:
+            return NUMBER.pack(dispatch('Epoch', ()))
+        if opcode == OP_LOCKACQUIRE:
+            client_id, lease, wait, shared = LOCKACQUIRE.unpack(payload)
+            return VERSION.pack(dispatch('LockAcquire', (client_id, lease, wait, shared == 1)))
+        if opcode == OP_LOCKRELEASE:
+            return NUMBER.pack(1 if dispatch('LockRelease', CHANGE.unpack(payload)) else 0)
+        if opcode == OP_LOCKRENEW:
+            return NUMBER.pack(1 if dispatch('LockRenew', LOCKRENEW.unpack(payload)) else 0)
+        raise ValueError('unknown opcode ' + str(opcode))
@@ -1,32 +1,420 @@
 import pickle, logging
+import os
+import random
 import argparse
+import signal
+import sys
 import time
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import ExitStack
+import socket
+import socketserver
 import fsconfig
+import blockprotocol
+import blockstore
+from blockxor import XorBlocks
 
 from xmlrpc.server import SimpleXMLRPCServer
 from xmlrpc.server import SimpleXMLRPCRequestHandler
 
+# size of the pool of block locks shared by all blocks
+NUM_BLOCK_LOCKS = 1024
+
+# returned by Get and GetMany in place of a block that does not match its checksum
+CORRUPT = b''
+# returned by Get and GetMany in place of a block that is all zeroes (see blockprotocol.ZERO_BLOCK)
+ZERO_BLOCK = blockprotocol.ZERO_BLOCK
+# checksum of a block that was not written or read yet
+NO_CHECKSUM = -1
+
 # Restrict to a particular path.
+# HTTP/1.1 keeps the client's connection open across requests instead of one TCP connection per request
 class RequestHandler(SimpleXMLRPCRequestHandler):
   rpc_paths = ('/RPC2',)
+  protocol_version = 'HTTP/1.1'
+
+# Each connection is served by its own thread, so one slow client (or a Sleep() delay) does not stall
+# the others, and kept-alive idle connections do not hold the server. Block operations lock the blocks
+# they touch (see DiskBlocks). In serial mode, requests instead run one at a time under request_lock.
+# The server speaks both XMLRPC and the binary block protocol (see blockprotocol.py) on the same port:
+# a connection that starts with the binary protocol's magic bytes is served by its handler instead.
+class BlockServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+  daemon_threads = True
+  # up to MAX_CLIENTS shells connect one connection per server each
+  request_queue_size = 64
+
+  def __init__(self, addr, requestHandler, serial = False):
+    SimpleXMLRPCServer.__init__(self, addr, requestHandler=requestHandler, use_builtin_types=True)
+    self.serial = serial
+    self.request_lock = threading.Lock()
 
+  def finish_request(self, request, client_address):
+    try:
+      magic = request.recv(len(blockprotocol.MAGIC), socket.MSG_PEEK)
+    except OSError:
+      return
+    if magic == blockprotocol.MAGIC:
+      blockprotocol.BinaryRequestHandler(request, client_address, self)
+    else:
+      SimpleXMLRPCServer.finish_request(self, request, client_address)
+
+  def _dispatch(self, method, params):
+    # a waiting LockAcquire must not keep the holder's LockRelease out, so it never takes request_lock
+    if not self.serial or method in LockService.BLOCKING_METHODS:
+      return SimpleXMLRPCServer._dispatch(self, method, params)
+    with self.request_lock:
+      return SimpleXMLRPCServer._dispatch(self, method, params)
+
+# Blocks are kept by a storage engine (see blockstore.py): in memory (only the blocks that are not all
+# zeroes with -sparse), or in a file mapped with mmap when the server is started with -store, so they
+# survive a restart. Get and GetMany send ZERO_BLOCK instead of a block of zeroes.
+# Every block has a CRC32 checksum, taken when it is written (or first read, for blocks in a -store file
+# that were not written since the server started) and checked on every read. A block that fails the check
+# is returned as CORRUPT, so the client rebuilds it from parity instead of using it (see block.py).
+# With -cblk, the server corrupts the stored copy of that block after its first write, to test this.
 class DiskBlocks():
-  def __init__(self, total_num_blocks, block_size, delayat):
+  def __init__(self, total_num_blocks, block_size, delayat, store = None, corrupt_block = None):
     # This class stores the raw block array
-    self.block = []
+    if store is None:
+      store = blockstore.MemoryStore(total_num_blocks, block_size)
+    self.store = store
+    self.total_num_blocks = total_num_blocks
+    self.block_size = block_size
+    self.zero = bytes(block_size)
     # initialize request counter
     self.counter = 0
+    self.counter_lock = threading.Lock()
     self.delayat = delayat
-    # Initialize raw blocks
-    for i in range (0, total_num_blocks):
-      putdata = bytearray(block_size)
-      self.block.insert(i,putdata)
+    # CRC32 of each block, until it is first written or read: NO_CHECKSUM
+    self.checksums = array('q', [NO_CHECKSUM]) * total_num_blocks
+    self.corrupt_block = corrupt_block
+    # every write gets the next version number; versions holds the version of each block written since
+    # the server started, so clients can ask which blocks changed since a version they have seen
+    self.version = 0
+    self.versions = {}
+    self.version_lock = threading.Lock()
+    # versions start over when the server restarts; the epoch, chosen at random at startup, tells clients
+    # that it did, even if it has taken more writes since than they have seen (e.g. with -store)
+    self.epoch = random.getrandbits(31)
+    # operations on a block are atomic (and linearizable) while different blocks are served concurrently.
+    # A block always maps to the same lock of a fixed-size pool, so startup does not grow with the block count
+    self.block_locks = []
+    for i in range (0, min(total_num_blocks, NUM_BLOCK_LOCKS)):
+      self.block_locks.append(threading.Lock())
+    # XOR requests are not idempotent: the latest one of each client, {client_id: [session, sequence, result]},
+    # and a lock per client that keeps a retried request out until the first try is done (see Once)
+    self.applied = {}
+    self.client_locks = {}
+    self.client_locks_lock = threading.Lock()
+
+  def BlockLock(self, block_number):
+    return self.block_locks[block_number % len(self.block_locks)]
+
+  # Takes every block lock, in order, so no block operation runs until the returned stack is closed.
+  # Other operations hold one block lock at a time, so this cannot deadlock
+  def LockAllBlocks(self):
+    stack = ExitStack()
+    for lock in self.block_locks:
+      stack.enter_context(lock)
+    return stack
+
+  # Reads a block and checks it against its checksum; returns CORRUPT on a mismatch.
+  # Called under the block's lock
+  def ReadChecked(self, block_number):
+    data = self.store.Read(block_number)
+    checksum = zlib.crc32(data)
+    if self.checksums[block_number] == NO_CHECKSUM:
+      self.checksums[block_number] = checksum
+    elif self.checksums[block_number] != checksum:
+      logging.error('DiskBlocks: checksum mismatch in block ' + str(block_number))
+      return CORRUPT
+    return data
+
+  # ReadChecked for Get and GetMany: ZERO_BLOCK for a block of zeroes, so it is not sent
+  def ReadReply(self, block_number):
+    data = self.ReadChecked(block_number)
+    if data == self.zero:
+      return ZERO_BLOCK
+    return data
+
+  # Writes a block and records its checksum; called under the block's lock
+  def WriteChecked(self, block_number, data):
+    self.store.Write(block_number, data)
+    # the checksum is taken from the stored block, which the store may have padded
+    self.checksums[block_number] = zlib.crc32(self.store.Read(block_number))
+    if block_number == self.corrupt_block:
+      self.corrupt_block = None
+      logging.warning('DiskBlocks: corrupting block ' + str(block_number))
+      corrupted = bytearray(self.store.Read(block_number))
+      corrupted[0] ^= 0xff
+      self.store.Write(block_number, corrupted)
+
+  # XORs delta into a block in place and returns the new block; called under the block's lock.
+  # A block that failed its checksum keeps its old checksum, so it stays CORRUPT until it is rebuilt
+  def XorChecked(self, block_number, delta):
+    data = self.ReadChecked(block_number)
+    if data == CORRUPT:
+      data = XorBlocks(self.store.Read(block_number), delta)[:self.block_size]
+      self.store.Write(block_number, data)
+      return CORRUPT
+    data = XorBlocks(data, delta)[:self.block_size]
+    self.WriteChecked(block_number, data)
+    return data
+
+  # Assigns the next version to a write of block_number; called under the block's lock
+  def NewVersion(self, block_number):
+    with self.version_lock:
+      self.version += 1
+      self.versions[block_number] = self.version
+      return self.version
+
+  # Runs operation() once per request id [client_id, session, sequence], which a client gives each request
+  # that XORs deltas: a retry of a request that was applied, e.g. after the client timed out in Sleep, returns
+  # the first result instead of XORing the deltas in twice. A client waits for each request to a server before
+  # sending the next, so only its latest request is kept. Requests without an id always run
+  def Once(self, request, operation):
+    if request is None:
+      return operation()
+    client_id, session, sequence = request
+    with self.client_locks_lock:
+      lock = self.client_locks.setdefault(client_id, threading.Lock())
+    with lock:
+      applied = self.applied.get(client_id)
+      if applied is not None and applied[0:2] == [session, sequence]:
+        logging.warning('DiskBlocks: request ' + str(sequence) + ' of client ' + str(client_id) + ' was applied already')
+        return applied[2]
+      result = operation()
+      self.applied[client_id] = [session, sequence, result]
+      return result
 
+  # Counts requests and delays every delayat-th one; only the delayed request's thread sleeps
   def Sleep(self):
-    self.counter += 1
-    if (self.counter % self.delayat) == 0:
+    with self.counter_lock:
+      self.counter += 1
+      delay = (self.counter % self.delayat) == 0
+    if delay:
       time.sleep(10)
 
+  ## Block operations, registered as RPCs on the server
+
+  def Get(self, block_number):
+    with self.BlockLock(block_number):
+      result = self.ReadReply(block_number)
+    self.Sleep()
+    return result
+
+  # Put returns the version of the write
+  def Put(self, block_number, data):
+    with self.BlockLock(block_number):
+      self.WriteChecked(block_number, data)
+      version = self.NewVersion(block_number)
+    self.Sleep()
+    return version
+
+  # Batched variants: one request reads or writes a list of blocks
+  def GetMany(self, block_numbers):
+    result = []
+    for block_number in block_numbers:
+      with self.BlockLock(block_number):
+        result.append(self.ReadReply(block_number))
+    self.Sleep()
+    return result
+
+  # returns the list of versions, one per block written. deltas, a list of (block_number, delta), are XORed
+  # into their blocks like XorPutMany does, so a client that writes data and parity to one server needs one
+  # request; their versions follow those of blocks. request is the request id of deltas (see Once)
+  def PutMany(self, blocks, deltas = (), request = None):
+    versions = self.Once(request, lambda: self.WriteMany(blocks, deltas))
+    self.Sleep()
+    return versions
+
+  def WriteMany(self, blocks, deltas):
+    versions = []
+    for block_number, data in blocks:
+      with self.BlockLock(block_number):
+        self.WriteChecked(block_number, data)
+        versions.append(self.NewVersion(block_number))
+    for block_number, delta in deltas:
+      with self.BlockLock(block_number):
+        self.XorChecked(block_number, delta)
+        versions.append(self.NewVersion(block_number))
+    return versions
+
+  # XOR-put: XORs delta into the block on the server, e.g. a parity update old_parity ^ new_parity sent by the
+  # client instead of reading the parity and writing it back. The read-modify-write is atomic under the block's
+  # lock, so concurrent updates of one block from different clients all apply. Returns the version of the
+  # write, or [version, new block] if new_block is True. A request id makes a retry safe (see Once)
+  def XorPut(self, block_number, delta, new_block = False, request = None):
+    result = self.Once(request, lambda: self.XorMany([(block_number, delta)], new_block)[0])
+    self.Sleep()
+    return result
+
+  # blocks is a list of (block_number, delta); returns the list of versions (or of [version, new block])
+  def XorPutMany(self, blocks, new_blocks = False, request = None):
+    result = self.Once(request, lambda: self.XorMany(blocks, new_blocks))
+    self.Sleep()
+    return result
+
+  def XorMany(self, blocks, new_blocks):
+    result = []
+    for block_number, delta in blocks:
+      with self.BlockLock(block_number):
+        data = self.XorChecked(block_number, delta)
+        version = self.NewVersion(block_number)
+      result.append([version, data] if new_blocks else version)
+    return result
+
+  # Snapshot and restore: the raw block array is saved to, or loaded from, a file on the server's host with one
+  # bulk write or read, nb*bs Bytes of blocks in order (the layout of a -store file). Both hold every block lock.
+  # Restore gives all blocks a new version, so clients drop them from their caches (see Changes), and new
+  # checksums. Both return the current version
+  def Snapshot(self, path):
+    with self.LockAllBlocks():
+      data = b''.join(bytes(self.store.Read(i)).ljust(self.block_size, b'\x00') for i in range(0, self.total_num_blocks))
+      with self.version_lock:
+        version = self.version
+    # written to a temporary file first, so a failed snapshot does not destroy an older one
+    with open(path + '.tmp', 'wb') as file:
+      file.write(data)
+    os.replace(path + '.tmp', path)
+    logging.info('DiskBlocks: snapshot of ' + str(self.total_num_blocks) + ' blocks saved to ' + path)
+    return version
+
+  def Restore(self, path):
+    with open(path, 'rb') as file:
+      data = file.read()
+    if len(data) != self.total_num_blocks * self.block_size:
+      raise ValueError('snapshot ' + path + ' has ' + str(len(data)) + ' Bytes, expected nb*bs='
+                       + str(self.total_num_blocks * self.block_size))
+    with self.LockAllBlocks():
+      for i in range(0, self.total_num_blocks):
+        self.store.Write(i, data[i*self.block_size:(i+1)*self.block_size])
+        self.checksums[i] = zlib.crc32(self.store.Read(i))
+      with self.version_lock:
+        self.version += 1
+        for i in range(0, self.total_num_blocks):
+          self.versions[i] = self.version
+        version = self.version
+    logging.info('DiskBlocks: ' + str(self.total_num_blocks) + ' blocks restored from ' + path)
+    return version
+
+  # Returns [current version, [[block_number, version], ...], epoch] for the blocks written after version since
+  def Changes(self, since):
+    with self.version_lock:
+      changed = [[block_number, version] for block_number, version in self.versions.items() if version > since]
+      return [self.version, changed, self.epoch]
+
+  # Returns the epoch chosen at startup: it differs once the server restarted, e.g. while being repaired
+  def Epoch(self):
+    return self.epoch
+
+  # read-and-set-memory: the read and the set happen atomically under the block's lock
+  def RSM(self, block_number):
+    RSM_LOCKED = bytearray(b'\x01') * 1
+    with self.BlockLock(block_number):
+      result = self.store.Read(block_number)
+      self.WriteChecked(block_number, bytearray(RSM_LOCKED.ljust(self.block_size,b'\x01')))
+    self.Sleep()
+    return result
+
+# Lock service: the file system lock, granted to waiting clients in FIFO order.
+# The lock is taken in shared mode (any number of readers at a time) or exclusive mode (one writer).
+# LockAcquire blocks on the server until the lock is granted or wait seconds pass; a client that is not
+# granted the lock yet keeps its place in the queue and calls again, so a waiting client costs one RPC
+# every wait seconds instead of a stream of RSM polls. A waiter that does not call again within
+# WAITER_GRACE seconds after its call returned is taken out of the queue.
+# The lock is granted with a lease: if a holder neither releases it nor calls LockAcquire again within
+# lease seconds, the lock is taken from it. Every grant gets a new, larger fencing token; LockRelease
+# only releases the lock with the holder's current token, so a client whose lease expired cannot release
+# the lock of the next holder. A holder renews its lease with LockRenew, which fails with a stale token, so
+# a client whose lease expired finds out before it writes (see block.DiskBlocks.CheckLease).
+class LockService():
+  BLOCKING_METHODS = ('LockAcquire',)
+  WAITER_GRACE = 2.0
+
+  def __init__(self):
+    self.condition = threading.Condition()
+    # holders: {client_id: [token, lease end]}; any number of shared holders or one exclusive holder
+    self.holders = {}
+    self.exclusive = False
+    self.token = 0
+    # waiting clients in arrival order: {client_id: [shared, time by which it must call again]}
+    self.waiting = OrderedDict()
+
+  # Takes the lock from holders whose lease ended, and drops waiters that stopped calling
+  def Expire(self, now):
+    for client_id in [client_id for client_id in self.holders if now >= self.holders[client_id][1]]:
+      logging.warning('LockService: lease of client ' + str(client_id) + ' expired')
+      del self.holders[client_id]
+    if len(self.holders) == 0:
+      self.exclusive = False
+    for client_id in [client_id for client_id in self.waiting if now >= self.waiting[client_id][1]]:
+      del self.waiting[client_id]
+
+  # A waiter is granted the lock if it is compatible with the holders and with every waiter ahead of it,
+  # so readers that arrive after a waiting writer do not overtake it
+  def CanGrant(self, client_id, shared):
+    if not shared:
+      return len(self.holders) == 0 and next(iter(self.waiting)) == client_id
+    if self.exclusive:
+      return False
+    for waiter in self.waiting:
+      if waiter == client_id:
+        return True
+      if not self.waiting[waiter][0]:
+        return False
+
+  # Returns the fencing token if the lock is granted to client_id, or 0 if wait seconds passed first
+  def LockAcquire(self, client_id, lease, wait, shared = False):
+    with self.condition:
+      deadline = time.time() + wait
+      while True:
+        now = time.time()
+        self.Expire(now)
+        if client_id in self.holders:
+          # the grant's reply may have been lost: renew it
+          self.holders[client_id][1] = now + lease
+          return self.holders[client_id][0]
+        self.waiting[client_id] = [shared, deadline + self.WAITER_GRACE]
+        if self.CanGrant(client_id, shared):
+          del self.waiting[client_id]
+          self.token += 1
+          self.holders[client_id] = [self.token, now + lease]
+          self.exclusive = not shared
+          self.condition.notify_all()
+          return self.token
+        if now >= deadline:
+          return 0
+        timeout = deadline - now
+        if len(self.holders) > 0:
+          timeout = min(timeout, min(holder[1] for holder in self.holders.values()) - now)
+        self.condition.wait(max(timeout, 0))
+
+  # Renews the lease of client_id; returns False if it does not hold the lock with this token any more
+  def LockRenew(self, client_id, token, lease):
+    with self.condition:
+      self.Expire(time.time())
+      if client_id not in self.holders or self.holders[client_id][0] != token:
+        logging.warning('LockService: stale renewal by client ' + str(client_id) + ' token ' + str(token))
+        return False
+      self.holders[client_id][1] = time.time() + lease
+      return True
+
+  # Returns True if the lock was released, False if client_id does not hold it with this token
+  def LockRelease(self, client_id, token):
+    with self.condition:
+      if client_id not in self.holders or self.holders[client_id][0] != token:
+        logging.warning('LockService: stale release by client ' + str(client_id) + ' token ' + str(token))
+        return False
+      del self.holders[client_id]
+      if len(self.holders) == 0:
+        self.exclusive = False
+      self.condition.notify_all()
+      return True
+
 if __name__ == "__main__":
 
   # Construct the argument parser
@@ -37,6 +425,11 @@ if __name__ == "__main__":
   ap.add_argument('-port', '--port', type=int, help='an integer value')
   ap.add_argument('-delayat', '--delayat', type=int, help='an integer value')
   ap.add_argument('-cblk', '--corrupt_block', type=int, help='must be a valid integer')
+  ap.add_argument('-mode', '--mode', choices=['threaded','serial'], default='threaded', help='threaded: requests run concurrently with per-block locking; serial: one request at a time')
+  ap.add_argument('-store', '--store', type=str, help='file to keep the blocks in (mmap); default: in memory, lost on exit')
+  ap.add_argument('-sparse', '--sparse', action='store_true', help='in memory, allocate only blocks that are not all zeroes')
+  ap.add_argument('-msync', '--msync', choices=blockstore.MSYNC_POLICIES, default='shutdown', help='when a -store file is flushed to disk: after every write, periodically, or on shutdown')
+  ap.add_argument('-msyncinterval', '--msync_interval', type=float, default=1.0, help='seconds between flushes with -msync periodic')
   args = ap.parse_args()
 
   if args.total_num_blocks:
@@ -45,8 +438,9 @@ if __name__ == "__main__":
     print('Must specify total number of blocks')
     quit()
 
-  if args.corrupt_block and (args.corrupt_block < 0 or args.corrupt_block >= TOTAL_NUM_BLOCKS):
+  if args.corrupt_block is not None and (args.corrupt_block < 0 or args.corrupt_block >= TOTAL_NUM_BLOCKS):
     print('corrupt block must be in a valid block number range')
+    quit()
   
   if args.block_size:
     BLOCK_SIZE = args.block_size
@@ -66,38 +460,47 @@ if __name__ == "__main__":
     # initialize delayat with artificially large number
     delayat = 1000000000
 
+  if args.store and args.sparse:
+    print('-sparse is for the in-memory store; a -store file is already allocated lazily')
+    quit()
+
   # initialize blocks
-  RawBlocks = DiskBlocks(TOTAL_NUM_BLOCKS, BLOCK_SIZE, delayat)
+  if args.store:
+    store = blockstore.MmapStore(args.store, TOTAL_NUM_BLOCKS, BLOCK_SIZE, args.msync, args.msync_interval)
+  elif args.sparse:
+    store = blockstore.SparseStore(TOTAL_NUM_BLOCKS, BLOCK_SIZE)
+  else:
+    store = blockstore.MemoryStore(TOTAL_NUM_BLOCKS, BLOCK_SIZE)
+  RawBlocks = DiskBlocks(TOTAL_NUM_BLOCKS, BLOCK_SIZE, delayat, store, args.corrupt_block)
 
   # Create server
-  server = SimpleXMLRPCServer(("127.0.0.1", PORT), requestHandler=RequestHandler)
-
+  server = BlockServer(("127.0.0.1", PORT), requestHandler=RequestHandler, serial=(args.mode == 'serial'))
 
-  def Get(block_number):
-    result = RawBlocks.block[block_number]
-    RawBlocks.Sleep()
-    return result
-
-  server.register_function(Get)
-
-  def Put(block_number, data):
-    RawBlocks.block[block_number] = data.data
-    RawBlocks.Sleep()
-    return 0
-
-  server.register_function(Put)
-
-  def RSM(block_number):
-    RSM_LOCKED = bytearray(b'\x01') * 1
-    result = RawBlocks.block[block_number]
-    # RawBlocks.block[block_number] = RSM_LOCKED
-    RawBlocks.block[block_number] = bytearray(RSM_LOCKED.ljust(BLOCK_SIZE,b'\x01'))
-    RawBlocks.Sleep()
-    return result
+  server.register_function(RawBlocks.Get, 'Get')
+  server.register_function(RawBlocks.Put, 'Put')
+  server.register_function(RawBlocks.GetMany, 'GetMany')
+  server.register_function(RawBlocks.PutMany, 'PutMany')
+  server.register_function(RawBlocks.RSM, 'RSM')
+  server.register_function(RawBlocks.XorPut, 'XorPut')
+  server.register_function(RawBlocks.XorPutMany, 'XorPutMany')
+  server.register_function(RawBlocks.Snapshot, 'Snapshot')
+  server.register_function(RawBlocks.Restore, 'Restore')
+  server.register_function(RawBlocks.Changes, 'Changes')
+  server.register_function(RawBlocks.Epoch, 'Epoch')
 
-  server.register_function(RSM)
+  Locks = LockService()
+  server.register_function(Locks.LockAcquire, 'LockAcquire')
+  server.register_function(Locks.LockRelease, 'LockRelease')
+  server.register_function(Locks.LockRenew, 'LockRenew')
 
   # Run the server's main loop
   print ("Running block server with nb=" + str(TOTAL_NUM_BLOCKS) + ", bs=" + str(BLOCK_SIZE) + " on port " + str(PORT))
 
-  server.serve_forever()
\ No newline at end of file
+  # SIGTERM shuts down like Ctrl-C, so the store is flushed and closed either way
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    store.Close()
\ No newline at end of file
@@ -0,0 +1,127 @@
+import logging
+import mmap
+import os
+import threading
+
+#### BLOCK STORAGE ENGINES (server side)
+
+# blockserver.DiskBlocks keeps its raw blocks in one of these stores. All expose the same interface:
+#     Read(block_number) -> bytes          Write(block_number, data)          Close()
+# Locking is done by DiskBlocks; stores only move bytes. Write raises ValueError for a block larger than the
+# block size, so the write fails (and the client gets a Fault) in every store instead of being kept or dropped.
+
+
+## Raises ValueError if data does not fit in a block
+
+def CheckBlockSize(data, block_size):
+    if len(data) > block_size:
+        raise ValueError('block of ' + str(len(data)) + ' Bytes is larger than the block size ' + str(block_size))
+
+
+## In-memory store: one bytearray per block; contents are lost when the server exits
+
+class MemoryStore():
+    def __init__(self, total_num_blocks, block_size):
+        self.block_size = block_size
+        self.block = []
+        for i in range(0, total_num_blocks):
+            self.block.append(bytearray(block_size))
+
+    def Read(self, block_number):
+        return self.block[block_number]
+
+    def Write(self, block_number, data):
+        CheckBlockSize(data, self.block_size)
+        self.block[block_number] = bytearray(data)
+
+    def Close(self):
+        return
+
+
+## Sparse in-memory store: only blocks that are not all zeroes are allocated, in a dict, so memory grows
+## with the live data instead of the number of blocks. Every other block reads as one shared zero block,
+## and writing zeroes to a block frees it
+
+class SparseStore():
+    def __init__(self, total_num_blocks, block_size):
+        self.block_size = block_size
+        self.zero = bytes(block_size)
+        self.block = {}
+
+    def Read(self, block_number):
+        return self.block.get(block_number, self.zero)
+
+    def Write(self, block_number, data):
+        CheckBlockSize(data, self.block_size)
+        if data == self.zero:
+            self.block.pop(block_number, None)
+        else:
+            self.block[block_number] = bytearray(data)
+
+    def Close(self):
+        return
+
+
+## Persistent store: all blocks live in one preallocated file mapped into memory with mmap
+## Read and Write are slice copies from/into the mapping, so memory overhead is constant per server
+## and startup time does not depend on the number of blocks. The file keeps its contents across restarts.
+## msync policy decides when dirty pages are flushed to the file:
+##   'write'    - after every Write (only the pages of that block)
+##   'periodic' - every interval seconds, from a background thread
+##   'shutdown' - only when the store is closed
+
+MSYNC_POLICIES = ('write', 'periodic', 'shutdown')
+
+class MmapStore():
+    def __init__(self, path, total_num_blocks, block_size, msync = 'shutdown', interval = 1.0):
+        if msync not in MSYNC_POLICIES:
+            logging.error('MmapStore: unknown msync policy ' + str(msync))
+            quit()
+        self.block_size = block_size
+        self.size = total_num_blocks * block_size
+        self.msync = msync
+        self.interval = interval
+        self.path = path
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        file_size = os.fstat(self.fd).st_size
+        if file_size == 0:
+            # new store: preallocate; the file system fills it with zeroes lazily
+            os.ftruncate(self.fd, self.size)
+        elif file_size != self.size:
+            print('Store file ' + path + ' has ' + str(file_size) + ' Bytes, expected nb*bs=' + str(self.size))
+            os.close(self.fd)
+            quit()
+        self.map = mmap.mmap(self.fd, self.size)
+
+        self.closed = threading.Event()
+        if self.msync == 'periodic':
+            self.flusher = threading.Thread(target=self.FlushPeriodically, daemon=True)
+            self.flusher.start()
+
+    def Read(self, block_number):
+        start = block_number * self.block_size
+        return self.map[start:start + self.block_size]
+
+    def Write(self, block_number, data):
+        CheckBlockSize(data, self.block_size)
+        start = block_number * self.block_size
+        self.map[start:start + len(data)] = data
+        if len(data) < self.block_size:
+            self.map[start + len(data):start + self.block_size] = bytes(self.block_size - len(data))
+        if self.msync == 'write':
+            # msync needs a page-aligned offset
+            page_start = (start // mmap.PAGESIZE) * mmap.PAGESIZE
+            self.map.flush(page_start, start + self.block_size - page_start)
+
+    def FlushPeriodically(self):
+        while not self.closed.wait(self.interval):
+            self.map.flush()
+
+    def Close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.map.flush()
+        self.map.close()
+        os.close(self.fd)
@@ -0,0 +1,60 @@
+import logging
+
+#### XOR KERNEL
+
+# Parity updates, degraded reads and repair all XOR whole blocks together.
+# Instead of XORing one byte at a time in a Python generator, blocks are XORed as a whole:
+#  - with NumPy (if installed), using bitwise_xor over a buffer of 64-bit words
+#  - otherwise, by converting each block to a single Python integer with int.from_bytes
+# Blocks shorter than the longest block are treated as padded with zeroes at the end
+
+# NumPy call overhead only pays off for larger blocks; below this size (in Bytes) integers are faster
+NUMPY_MIN_BLOCK_SIZE = 1024
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+## XOR any number of blocks (bytes, bytearray or memoryview) together in one call
+## Returns a new bytearray; the arguments are not modified
+
+def XorBlocks(*blocks):
+    if len(blocks) == 0:
+        logging.error('XorBlocks: no blocks to XOR')
+        quit()
+    length = max(len(b) for b in blocks)
+    if numpy is not None and length >= NUMPY_MIN_BLOCK_SIZE:
+        return XorBlocksNumpy(blocks, length)
+    return XorBlocksInt(blocks, length)
+
+
+## XOR of a list of blocks using Python integers
+## little-endian keeps zero padding of short blocks at the end of the block
+
+def XorBlocksInt(blocks, length):
+    result = 0
+    for b in blocks:
+        result ^= int.from_bytes(b, byteorder='little')
+    return bytearray(result.to_bytes(length, byteorder='little'))
+
+
+## XOR of a list of blocks using NumPy, folding every block into one accumulator buffer
+
+def XorBlocksNumpy(blocks, length):
+    # use 64-bit words when the length allows it, bytes otherwise
+    if length % 8 == 0:
+        dtype = numpy.uint64
+    else:
+        dtype = numpy.uint8
+    result = bytearray(length)
+    accumulator = numpy.frombuffer(result, dtype=dtype)
+    accumulator_bytes = numpy.frombuffer(result, dtype=numpy.uint8)
+    for b in blocks:
+        if len(b) == length:
+            numpy.bitwise_xor(accumulator, numpy.frombuffer(b, dtype=dtype), out=accumulator)
+        else:
+            short = accumulator_bytes[0:len(b)]
+            numpy.bitwise_xor(short, numpy.frombuffer(b, dtype=numpy.uint8), out=short)
+    return result
@@ -138,6 +138,9 @@ class FileOperations():
         # bytes_written keeps track of the total number of bytes written
         # start with zero
         bytes_written = 0
+        # (block_number, write_start, write_end, data_start) of each block to be written
+        # all blocks are read and written in batches after the loop, with one round trip per server
+        block_writes = []
 
         # the data to be written may span multiple blocks
         # this loop iterates through one or more blocks, ending when all data is written
@@ -182,15 +185,7 @@ class FileOperations():
                 block_number = new_block
 
             # now we have either an existing block, or a newly allocated one
-            # either way, first, we read the whole block from raw storage
-            # (if it's a newly allocated block, it's full of zeroes)
-            block = self.FileNameObject.RawBlocks.Get(block_number)
-
-            # copy slice of data into the right position in this block
-            block[write_start:write_end] = data[bytes_written:bytes_written + (write_end - write_start)]
-
-            # now write modified block back to disk
-            self.FileNameObject.RawBlocks.Put(block_number, block)
+            block_writes.append((block_number, write_start, write_end, bytes_written))
 
             # update offset, bytes written
             current_offset += write_end - write_start
@@ -199,6 +194,22 @@ class FileOperations():
             logging.debug('FileOperations::Write: current_offset: ' + str(current_offset) + ' , bytes_written: ' + str(
                 bytes_written) + ' , len(data): ' + str(len(data)))
 
+        # blocks that are only partially overwritten are first read whole from raw storage
+        # (if it's a newly allocated block, it's full of zeroes)
+        partial_blocks = []
+        for block_number, write_start, write_end, data_start in block_writes:
+            if write_start != 0 or write_end != fsconfig.BLOCK_SIZE:
+                partial_blocks.append(block_number)
+        old_blocks = dict(zip(partial_blocks, self.FileNameObject.RawBlocks.GetBlocks(partial_blocks)))
+
+        # copy slices of data into the right position in each block, and write all blocks back to disk
+        put_blocks = []
+        for block_number, write_start, write_end, data_start in block_writes:
+            block = old_blocks.get(block_number, bytearray(fsconfig.BLOCK_SIZE))
+            block[write_start:write_end] = data[data_start:data_start + (write_end - write_start)]
+            put_blocks.append((block_number, block))
+        self.FileNameObject.RawBlocks.PutBlocks(put_blocks)
+
         # Update inode's metadata to increment size by bytes_written, and write inode back to inode table in raw storage
         file_inode.inode.size = offset + bytes_written
         file_inode.StoreInode(self.FileNameObject.RawBlocks)
@@ -235,6 +246,9 @@ class FileOperations():
             bytes_to_read = count
 
         read_data = bytearray(bytes_to_read)
+        # (block_number, read_start, read_end, data_start) of each block to be read
+        # all blocks are read in one batch after the loop, with one round trip per server
+        block_reads = []
 
         # this loop iterates through one or more blocks, ending when all data is read
         while bytes_read < bytes_to_read:
@@ -262,17 +276,20 @@ class FileOperations():
          # retrieve index of block to be written from inode's list
             block_number = file_inode.inode.block_numbers[current_block_index]
 
-            # first, we read the whole block from raw storage
-            block = self.FileNameObject.RawBlocks.Get(block_number)
-
-            # copy slice of data from block into the right position in the read_block
-            read_data[bytes_read:bytes_read + (read_end - read_start)] = block[read_start:read_end]
+            block_reads.append((block_number, read_start, read_end, bytes_read))
 
             bytes_read += read_end - read_start
             current_offset += read_end - read_start
 
             logging.debug('FileOperations::Read: current_offset: ' + str(current_offset) + ' , bytes_read: ' + str(bytes_read))
 
+        # read the whole blocks from raw storage
+        blocks = self.FileNameObject.RawBlocks.GetBlocks([block_read[0] for block_read in block_reads])
+
+        # copy slice of data from each block into the right position in the read_block
+        for (block_number, read_start, read_end, data_start), block in zip(block_reads, blocks):
+            read_data[data_start:data_start + (read_end - read_start)] = block[read_start:read_end]
+
         return read_data, "SUCCESS"
     ## Skeleton functions - you'll implement these in HW#2
 
@@ -6,6 +6,7 @@ global INODE_TYPE_INVALID, INODE_TYPE_FILE, INODE_TYPE_DIR, INODE_TYPE_SYM
 global INODES_PER_BLOCK, FREEBITMAP_NUM_BLOCKS, INODE_BLOCK_OFFSET, INODE_NUM_BLOCKS, MAX_INODE_BLOCK_NUMBERS, \
         MAX_FILE_SIZE, DATA_BLOCKS_OFFSET, DATA_NUM_BLOCKS, FILE_NAME_DIRENTRY_SIZE, FILE_ENTRIES_PER_DATA_BLOCK
 global CID, PORT, MAX_CLIENTS, SERVER_ADDRESS, RSM_UNLOCKED, RSM_LOCKED, SOCKET_TIMEOUT, RETRY_INTERVAL
+global PROTOCOL, CACHE_POLICY, CACHE_CAPACITY, REPAIR_RATE, SCRUB_RATE, RAID_LEVEL, STRIPE_UNIT, READ_BALANCE, BACKEND
 
 # Useful variables that are derived from the above
 # Call this function to compute derived file system parameters
@@ -16,6 +17,7 @@ def ConfigureFSConstants(args):
 
     global TOTAL_NUM_BLOCKS, BLOCK_SIZE, MAX_NUM_INODES, INODE_SIZE, NUM_SERVERS, LOGCACHE
     global CID, PORT, MAX_CLIENTS, SERVER_ADDRESS, RSM_UNLOCKED, RSM_LOCKED, SOCKET_TIMEOUT, RETRY_INTERVAL
+    global PROTOCOL, CACHE_POLICY, CACHE_CAPACITY, REPAIR_RATE, SCRUB_RATE, RAID_LEVEL, STRIPE_UNIT, READ_BALANCE, BACKEND
     # Default values
     # Total number of blocks in raw storage
     TOTAL_NUM_BLOCKS = 256
@@ -29,6 +31,26 @@ def ConfigureFSConstants(args):
     PORT = 8000
     NUM_SERVERS = 1
     LOGCACHE = 0
+    # RAID level of the block servers (0, 1, 5 or 6) and stripe unit in blocks (see blocklayout.py)
+    RAID_LEVEL = 5
+    STRIPE_UNIT = 1
+    # Wire protocol to the block servers: 'xmlrpc' or 'binary' (see blockprotocol.py)
+    PROTOCOL = 'xmlrpc'
+    # Client block cache: 'writethrough' sends every Put to the servers at once; 'writeback' keeps
+    # writes made while holding the lock in the cache and flushes them in Release (see block.py)
+    CACHE_POLICY = 'writethrough'
+    # Maximum number of blocks in the client block cache (least recently used blocks are evicted); 0: no limit
+    CACHE_CAPACITY = 1024
+    # Maximum repair (rebuild) throughput in MB/s; 0: no limit
+    REPAIR_RATE = 0
+    # Maximum parity scrub throughput (Bytes read from all servers) in MB/s; 0: no limit
+    SCRUB_RATE = 0
+    # Read balancing: 'on' spreads reads across the copies of a block (RAID-1), or rebuilds the blocks of a
+    # hot server from parity instead of reading it (RAID-5/6); 'off' always reads where the layout stores a block
+    READ_BALANCE = 'off'
+    # Where the blocks are kept: 'servers' are the block server processes at PORT; 'local' keeps NUM_SERVERS
+    # in-process servers in memory (see blocklocal.py), for running the file system without block servers
+    BACKEND = 'servers'
     # Override defaults if provided in command line arguments (args)
     if args.total_num_blocks:
         TOTAL_NUM_BLOCKS = args.total_num_blocks
@@ -48,6 +70,26 @@ def ConfigureFSConstants(args):
        LOGCACHE = 1
     if args.startport!=8000:
        PORT = args.startport
+    if args.raid is not None:
+       RAID_LEVEL = args.raid
+    if args.stripe_unit:
+       STRIPE_UNIT = args.stripe_unit
+    if args.protocol:
+       PROTOCOL = args.protocol
+    if args.cache_policy:
+       CACHE_POLICY = args.cache_policy
+    if args.cache_blocks is not None:
+       CACHE_CAPACITY = args.cache_blocks
+    if args.cache_bytes is not None:
+       CACHE_CAPACITY = max(1, args.cache_bytes // BLOCK_SIZE)
+    if args.repair_rate:
+       REPAIR_RATE = args.repair_rate
+    if args.scrub_rate:
+       SCRUB_RATE = args.scrub_rate
+    if args.read_balance:
+       READ_BALANCE = args.read_balance
+    if args.backend:
+       BACKEND = args.backend
 
     # These are constants that SHOULD NEVER BE MODIFIED
     global MAX_FILENAME, INODE_NUMBER_DIRENTRY_SIZE, FREEBITMAP_BLOCK_OFFSET, INODE_BYTES_SIZE_TYPE_REFCNT, \
@@ -124,6 +166,25 @@ def ConfigureFSConstants(args):
     MAX_CLIENTS = 8
     SOCKET_TIMEOUT = 5
     RETRY_INTERVAL = 10
+    # Lock service (see blockserver.LockService): lease of a granted lock, and how long one LockAcquire
+    # call waits on the server (must be less than SOCKET_TIMEOUT)
+    global LOCK_LEASE, LOCK_WAIT, RSM_BACKOFF_MIN, RSM_BACKOFF_MAX
+    LOCK_LEASE = 60
+    LOCK_WAIT = 4
+    # Exponential backoff of RSM polling (in seconds), for servers without the lock service
+    RSM_BACKOFF_MIN = 0.01
+    RSM_BACKOFF_MAX = 1.0
+    # repair and scrub: stripe levels per batch (one lock hold, one RPC per server)
+    global REPAIR_BATCH
+    REPAIR_BATCH = 64
+    # seconds between background probes of servers that are suspect or down
+    global PROBE_INTERVAL
+    PROBE_INTERVAL = 1.0
+    # read balancing: weight of the newest response time in a server's moving average, and how many times
+    # the average expected wait of the other servers makes a server hot (see blockio.ServerLoad)
+    global READ_BALANCE_WEIGHT, READ_BALANCE_FACTOR
+    READ_BALANCE_WEIGHT = 0.2
+    READ_BALANCE_FACTOR = 2.0
 
 
 ## Prints out file system information
@@ -10,6 +10,31 @@ from absolutepath import *
 
 import os.path
 
+## Constructs the argument parser of the file system's command-line options
+
+def ArgumentParser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-nb', '--total_num_blocks', type=int, help='an integer value')
+    ap.add_argument('-bs', '--block_size', type=int, help='an integer value')
+    ap.add_argument('-ni', '--max_num_inodes', type=int, help='an integer value')
+    ap.add_argument('-is', '--inode_size', type=int, help='an integer value')
+    ap.add_argument('-cid', '--client_id', type=int, help='an integer value')
+    ap.add_argument('-port', '--port', type=int, help='an integer value')
+    ap.add_argument('-ns', '--number_of_servers',type=int, help='an integer number')
+    ap.add_argument('-logcache','--logcache',type=int, help='must by 0 or 1')
+    ap.add_argument('-startport','--startport',type=int, help='must be a valid available port number')
+    ap.add_argument('-raid','--raid',type=int,choices=[0,1,5,6], help='RAID level of the block servers')
+    ap.add_argument('-stripeunit','--stripe_unit',type=int, help='stripe unit in blocks')
+    ap.add_argument('-protocol','--protocol',choices=['xmlrpc','binary'], help='wire protocol to the block servers')
+    ap.add_argument('-cachepolicy','--cache_policy',choices=['writethrough','writeback'], help='client block cache write policy')
+    ap.add_argument('-cacheblocks','--cache_blocks',type=int, help='client block cache size in blocks (0: no limit)')
+    ap.add_argument('-cachebytes','--cache_bytes',type=int, help='client block cache size in Bytes')
+    ap.add_argument('-repairrate','--repair_rate',type=float, help='maximum repair throughput in MB/s')
+    ap.add_argument('-scrubrate','--scrub_rate',type=float, help='maximum parity scrub throughput in MB/s')
+    ap.add_argument('-readbalance','--read_balance',choices=['off','on'], help='balance reads across servers by load')
+    ap.add_argument('-backend','--backend',choices=['servers','local'], help='block servers, or in-process servers in memory (no -port needed)')
+    return ap
+
 if __name__ == "__main__":
 
     # Initialize file for logging
@@ -22,16 +47,7 @@ if __name__ == "__main__":
     logging.getLogger().addHandler(console_handler)
 
     # Construct the argument parser
-    ap = argparse.ArgumentParser()
-    ap.add_argument('-nb', '--total_num_blocks', type=int, help='an integer value')
-    ap.add_argument('-bs', '--block_size', type=int, help='an integer value')
-    ap.add_argument('-ni', '--max_num_inodes', type=int, help='an integer value')
-    ap.add_argument('-is', '--inode_size', type=int, help='an integer value')
-    ap.add_argument('-cid', '--client_id', type=int, help='an integer value')
-    ap.add_argument('-port', '--port', type=int, help='an integer value')
-    ap.add_argument('-ns', '--number_of_servers',type=int, help='an integer number')
-    ap.add_argument('-logcache','--logcache',type=int, help='must by 0 or 1')
-    ap.add_argument('-startport','--startport',type=int, help='must be a valid available port number')
+    ap = ArgumentParser()
 
     # Other than FS args, consecutive args will be captured in by 'arg' as list
     ap.add_argument('arg', nargs='*')
@@ -0,0 +1,31 @@
+import logging
+import sys
+import time
+
+import fsconfig
+from fsmain import ArgumentParser
+from block import DiskBlocks
+
+#### Parity scrubber
+# A block layer client of its own that checks the parity of every stripe level (see block.DiskBlocks.scrub),
+# with -fix also rewriting parity that does not match. With -interval, it scrubs again every interval
+# seconds, in the background of the shells using the same servers; give it a -cid of its own.
+# The rate is limited with -scrubrate (MB/s). Exits with status 1 if a single pass found mismatches.
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+
+    ap = ArgumentParser()
+    ap.add_argument('-fix', '--fix', action='store_true', help='rewrite the parity of mismatched stripe levels')
+    ap.add_argument('-interval', '--interval', type=float, default=0, help='seconds between scrubs (0: scrub once)')
+    args = ap.parse_args()
+
+    fsconfig.ConfigureFSConstants(args)
+    RawBlocks = DiskBlocks()
+
+    while True:
+        mismatched = RawBlocks.scrub(args.fix)
+        if args.interval <= 0:
+            sys.exit(0 if mismatched is not None and len(mismatched) == 0 else 1)
+        time.sleep(args.interval)
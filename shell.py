@@ -25,6 +25,17 @@ class FSShell():
         fsconfig.PrintFSConstants()
         return 0
 
+    # implements showservers (state and load of each block server)
+    def showservers(self):
+        states = self.RawBlocks.ServerStates()
+        stats = self.RawBlocks.LoadStats()
+        print ('server  state    requests  queued  latency(ms)  offloaded')
+        for i in range(0, len(states)):
+            latency = stats[i]['latency_ms']
+            print (str(i).ljust(8) + states[i].ljust(9) + str(stats[i]['requests']).ljust(10) + str(stats[i]['queued']).ljust(8)
+                   + ('-' if latency is None else str(latency)).ljust(13) + str(stats[i]['offloaded']))
+        return 0
+
     # implements showinode (log inode i contents)
     def showinode(self, i):
         try:
@@ -276,7 +287,25 @@ class FSShell():
         else:
             print("Enter valid server number")
 
+    # implements scrub (check each stripe's parity against its data; scrub fix also rewrites bad parity)
+    def scrub(self, mode):
+        if mode not in ('check', 'fix'):
+            print("Error: scrub takes no argument or fix")
+            return -1
+        if self.RawBlocks.scrub(mode == 'fix') is None:
+            return -1
+        return 0
+
+    # implements snapshot (save all block servers to files on their hosts) and restore (load them back)
+    def snapshot(self, path):
+        return self.RawBlocks.snapshot(path)
+
+    def restore(self, path):
+        return self.RawBlocks.restore(path)
+
     ## Main interpreter loop
+    # Commands that only read the file system (cd, cat, ls) take the lock in shared mode, so clients can
+    # run them at the same time; commands that write take it in exclusive mode
     def Interpreter(self):
         while (True):
             command = input("[cwd=" + str(self.cwd) + "]%")
@@ -287,18 +316,18 @@ class FSShell():
                 if len(splitcmd) != 2:
                     print ("Error: cd requires one argument")
                 else:
-                    self.RawBlocks.Acquire()
+                    self.RawBlocks.Acquire(shared=True)
                     self.cd(splitcmd[1])
                     self.RawBlocks.Release()
             elif splitcmd[0] == "cat":
                 if len(splitcmd) != 2:
                     print ("Error: cat requires one argument")
                 else:
-                    self.RawBlocks.Acquire()
+                    self.RawBlocks.Acquire(shared=True)
                     self.cat(splitcmd[1])
                     self.RawBlocks.Release()
             elif splitcmd[0] == "ls":
-                self.RawBlocks.Acquire()
+                self.RawBlocks.Acquire(shared=True)
                 self.ls()
                 self.RawBlocks.Release()
             elif splitcmd[0] == "showblock":
@@ -321,6 +350,11 @@ class FSShell():
                     print ("Error: showfsconfig do not require argument")
                 else:
                     self.showfsconfig()
+            elif splitcmd[0] == "showservers":
+                if len(splitcmd) != 1:
+                    print ("Error: showservers do not require argument")
+                else:
+                    self.showservers()
             elif splitcmd[0] == "load":
                 if len(splitcmd) != 2:
                     print ("Error: load requires 1 argument")
@@ -392,6 +426,21 @@ class FSShell():
                     print("Error: repair command takes one argument as a valid server id/number")
                 else:
                     self.repair(splitcmd[1])
+            elif splitcmd[0] == "scrub":
+                if len(splitcmd) > 2:
+                    print("Error: scrub takes at most one argument")
+                else:
+                    self.scrub(splitcmd[1] if len(splitcmd) == 2 else 'check')
+            elif splitcmd[0] == "snapshot":
+                if len(splitcmd) != 2:
+                    print ("Error: snapshot requires 1 argument")
+                else:
+                    self.snapshot(splitcmd[1])
+            elif splitcmd[0] == "restore":
+                if len(splitcmd) != 2:
+                    print ("Error: restore requires 1 argument")
+                else:
+                    self.restore(splitcmd[1])
             elif splitcmd[0] == "exit":
                 return
             else: